@@ -0,0 +1,225 @@
+import hashlib
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import redis
+import redis.asyncio
+
+COLORS = ["green", "yellow", "red"]
+TAGS = ["vegetarian", "vegan", "organic", "climate friendly", "H2O A", "CO2 B"]
+GROUPS = ["Vorspeisen", "Salate", "Suppen", "Aktionen", "Essen", "Beilagen"]
+UNIVERSITIES = {
+    "HU": ["Mensa Nord", "Mensa Süd", "Mensa Adlershof", "Coffeebar Nord"],
+    "FU": ["Mensa II", "Mensa Lankwitz", "Mensa Dahlem"],
+    "TU": ["Mensa Hardenbergstraße", "Mensa Marchstraße"],
+    "Beuth": ["Mensa Luxemburger Straße"],
+    "HTW": ["Mensa Treskowallee", "Mensa Wilhelminenhof"],
+}
+
+
+def make_menu(mensa: int, date: str) -> List[dict]:
+    seed = mensa * 31 + sum(map(ord, date))
+    return [
+        dict(
+            name=group,
+            items=[
+                dict(
+                    name=f"{group} {mensa}/{n}",
+                    color=COLORS[(seed + n) % len(COLORS)],
+                    tags=TAGS[(seed + n) % len(TAGS) :][: 1 + n % 2],
+                    price=dict(student=95 + 35 * ((seed + n) % 9)),
+                    allergens=[
+                        dict(number=(seed + n) % 14 + 1, index=None),
+                        dict(number=1, index="a"),
+                    ][: n % 3],
+                )
+                for n in range(4)
+            ],
+        )
+        for group in GROUPS
+    ]
+
+
+def make_codes() -> List[dict]:
+    codes = itertools.count(1)
+    return [
+        dict(
+            name=university,
+            items=[
+                dict(code=next(codes), name=mensa, address="Berlin") for mensa in mensas
+            ],
+        )
+        for university, mensas in UNIVERSITIES.items()
+    ]
+
+
+ALLERGENS = dict(
+    items=[
+        dict(number=number, index=None, name=f"Allergen {number}")
+        for number in range(1, 15)
+    ]
+    + [dict(number=1, index="a", name="Weizen")]
+)
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "FakeApi"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.count(url.path)
+        time.sleep(self.server.latency)
+        if url.path == "/menu":
+            body = make_menu(int(params.get("mensa", 0)), params.get("date", ""))
+        elif url.path == "/allergens":
+            body = ALLERGENS
+        elif url.path == "/codes":
+            pattern = params.get("pattern", "").lower()
+            body = [
+                dict(
+                    university,
+                    items=[
+                        mensa
+                        for mensa in university["items"]
+                        if pattern in university["name"].lower()
+                        or pattern in mensa["name"].lower()
+                    ],
+                )
+                for university in make_codes()
+            ]
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        if self.server.conditional and self.not_modified(etag):
+            self.server.count_not_modified()
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.server.count_bytes(len(data))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if self.server.conditional:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.server.last_modified)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_modified(self, etag: str) -> bool:
+        if "If-None-Match" in self.headers:
+            return self.headers["If-None-Match"] == etag
+        return self.headers.get("If-Modified-Since") == self.server.last_modified
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, conditional: bool = True) -> None:
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.latency = latency
+        self.conditional = conditional
+        self.last_modified = formatdate(usegmt=True)
+        self.requests: Dict[str, int] = dict()
+        self.bytes_sent = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, path: str) -> None:
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def count_bytes(self, size: int) -> None:
+        with self.lock:
+            self.bytes_sent += size
+
+    def count_not_modified(self) -> None:
+        with self.lock:
+            self.not_modified += 1
+
+
+class FakeMessage(object):
+    def __init__(self, message_id: int, chat_id: int, text: str) -> None:
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.text = text
+
+
+class FakeBot(object):
+    defaults = None
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.sent: List[FakeMessage] = []
+        self.condition = threading.Condition()
+        self.ids = itertools.count(1)
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> FakeMessage:
+        if self.latency:
+            time.sleep(self.latency)
+        message = FakeMessage(next(self.ids), chat_id, text)
+        with self.condition:
+            self.sent.append(message)
+            self.condition.notify_all()
+        return message
+
+    def edit_message_text(self, text: str, **kwargs) -> FakeMessage:
+        return FakeMessage(kwargs.get("message_id", 0), kwargs.get("chat_id", 0), text)
+
+    def wait_for(self, count: int, timeout: float = 60.0) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.sent) >= count, timeout)
+
+    def reset(self) -> None:
+        with self.condition:
+            self.sent.clear()
+
+
+class FakeUpdate(object):
+    def __init__(self, chat_id: int) -> None:
+        self.effective_message = self.message = FakeMessage(0, chat_id, "")
+
+
+class FakeContext(object):
+    def __init__(self, bot: FakeBot, args: List[str]) -> None:
+        self.bot = bot
+        self.args = args
+
+
+def make_redis(
+    url: Optional[str] = None,
+) -> Tuple[redis.Redis, redis.asyncio.Redis]:
+    if url:
+        return (
+            redis.Redis.from_url(url, decode_responses=True),
+            redis.asyncio.Redis.from_url(url, decode_responses=True),
+        )
+    try:
+        import fakeredis
+        import fakeredis.aioredis
+    except ImportError:
+        raise SystemExit("Install fakeredis or pass --redis redis://localhost/15")
+    server = fakeredis.FakeServer()
+    return (
+        fakeredis.FakeRedis(server=server, decode_responses=True),
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+    )
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import argparse
+import timeit
+
+from menstruation.query import Query, parse_filter
+
+FILTERS = [
+    "",
+    "tomorrow",
+    "2,50€ :green_heart: :yellow_heart:",
+    ":seedling: :carrot: 3€ today",
+    ":fish: :smiling_face_with_halo: 4,20 € 2021-11-03",
+    "3.5€ :red_heart: :globe_showing_Americas: tomorrow",
+]
+
+
+def parse_all() -> None:
+    for text in FILTERS:
+        Query.from_text(text)
+
+
+def parse_all_uncached() -> None:
+    for text in FILTERS:
+        parse_filter.cache_clear()
+        Query.from_text(text)
+
+
+def run(name, func, number: int) -> None:
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    parses = number * len(FILTERS)
+    print(
+        f"{name:<10} {parses / seconds:>12,.0f} parses/s "
+        f"{seconds / parses * 1e6:>8.2f} µs/parse"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure Query.from_text throughput")
+    parser.add_argument("-n", "--number", type=int, default=10_000)
+    args = parser.parse_args()
+    run("uncached", parse_all_uncached, args.number)
+    run("cached", parse_all, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+from datetime import date, timedelta
+from queue import Queue
+from time import perf_counter, process_time, time
+from typing import Callable, Dict, List
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "benchmark")
+
+from telegram.ext import Dispatcher, JobQueue
+
+import menstruation.client as client
+from menstruation import config, jobs, runtime, sender  # jobs first, like bot.py
+from menstruation import handlers
+from menstruation.query import Query
+
+from benchmarks.fakes import FakeApi, FakeBot, FakeContext, FakeUpdate, make_redis
+
+FILTERS = ["", ":seedling:", ":carrot: 3€", ":green_heart: :yellow_heart: 2,50€"]
+
+
+class UnthrottledQueue(sender.MessageQueue):
+    GLOBAL_RATE = 1_000_000
+    CHAT_BURST = 1_000_000
+
+
+def summarise(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    return dict(
+        n=len(samples),
+        mean_ms=statistics.mean(samples) * 1000,
+        p50_ms=samples[len(samples) // 2] * 1000,
+        p95_ms=samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        max_ms=samples[-1] * 1000,
+    )
+
+
+def clear_caches() -> None:
+    for cache in (client.menu_cache, client.allergens_cache, client.codes_cache):
+        cache.clear()
+    keys = list(config.user_db.redis.scan_iter(f"{client.SharedCache.PREFIX}*"))
+    if keys:
+        config.user_db.redis.delete(*keys)
+
+
+def populate(subscribers: int, mensas: int) -> List[int]:
+    user_ids = list(range(1, subscribers + 1))
+    pipeline = config.user_db.redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipeline.hset(
+            str(user_id),
+            mapping=dict(
+                mensa=str(user_id % mensas + 1),
+                subscribed="yes",
+                menu_filter=FILTERS[user_id % len(FILTERS)],
+            ),
+        )
+        pipeline.sadd(config.user_db.USERS_KEY, str(user_id))
+        pipeline.sadd(config.user_db.SUBSCRIBERS_KEY, str(user_id))
+        pipeline.sadd(config.user_db.DEFAULT_SCHEDULE_KEY, str(user_id))
+    pipeline.execute()
+    return user_ids
+
+
+def send_menu_once(bot: FakeBot, chat_id: int, text: str) -> float:
+    bot.reset()
+    start = perf_counter()
+    runtime.loop.call(handlers.send_menu(bot, chat_id, Query.from_text(text)))
+    bot.wait_for(1)
+    return perf_counter() - start
+
+
+def bench_send_menu(bot: FakeBot, iterations: int, cold: bool) -> dict:
+    samples = []
+    if not cold:
+        send_menu_once(bot, 1, FILTERS[1])
+    for n in range(iterations):
+        if cold:
+            clear_caches()
+            samples.append(send_menu_once(bot, n % 50 + 1, FILTERS[n % len(FILTERS)]))
+        else:
+            samples.append(send_menu_once(bot, 1, FILTERS[1]))
+    return summarise(samples)
+
+
+def bench_menu_throughput(bot: FakeBot, requests: int) -> dict:
+    clear_caches()
+    bot.reset()
+    today = date.today()
+    calls = [
+        (
+            FakeUpdate(n % 500 + 1),
+            FakeContext(
+                bot,
+                [
+                    (today + timedelta(days=n % 7)).isoformat(),
+                    FILTERS[n % len(FILTERS)],
+                ],
+            ),
+        )
+        for n in range(requests)
+    ]
+    start = perf_counter()
+    # all requests are in flight on the event loop at once
+    for call in calls:
+        handlers.menu_handler(*call)
+    bot.wait_for(requests)
+    elapsed = perf_counter() - start
+    return dict(
+        requests=requests,
+        seconds=elapsed,
+        requests_per_second=requests / elapsed,
+    )
+
+
+def bench_notification_burst(bot: FakeBot, user_ids: List[int]) -> dict:
+    clear_caches()
+    bot.reset()
+    start = perf_counter()
+    jobs.notify_subscribers(bot, user_ids)
+    bot.wait_for(len(user_ids))
+    elapsed = perf_counter() - start
+    return dict(
+        subscribers=len(user_ids),
+        delivered=len(bot.sent),
+        seconds=elapsed,
+        messages_per_second=len(bot.sent) / elapsed,
+    )
+
+
+def bench_startup(bot: FakeBot, rebuild: bool) -> dict:
+    if rebuild:
+        config.user_db.redis.delete(
+            config.user_db.USERS_KEY,
+            config.user_db.SUBSCRIBERS_KEY,
+            config.user_db.SCHEDULE_KEY,
+            config.user_db.DEFAULT_SCHEDULE_KEY,
+        )
+    job_queue = JobQueue()
+    job_queue.set_dispatcher(Dispatcher(bot, Queue(), job_queue=job_queue))
+    start = perf_counter()
+    jobs.setup_job_queue(job_queue)
+    elapsed = perf_counter() - start
+    job_queue.scheduler.remove_all_jobs()
+    job_queue.stop()
+    return dict(rebuild_index=rebuild, seconds=elapsed)
+
+
+def bench_revalidation(api: FakeApi, mensas: int, rounds: int) -> dict:
+    today = date.today().isoformat()
+    urls = [
+        client.menu_url(api.endpoint, mensa, Query.from_text(today))
+        for mensa in range(1, mensas + 1)
+    ]
+    results = dict()
+    for conditional in (False, True):
+        api.conditional = conditional
+        clear_caches()
+        for url in urls:
+            client.menu_cache.get(url)
+        not_modified, bytes_sent = api.not_modified, api.bytes_sent
+        start, cpu = perf_counter(), process_time()
+        for _ in range(rounds):
+            for url in urls:
+                runtime.loop.call(client.menu_cache.refresh(url))
+        elapsed, cpu = perf_counter() - start, process_time() - cpu
+        results["conditional" if conditional else "unconditional"] = dict(
+            refreshes=rounds * len(urls),
+            not_modified=api.not_modified - not_modified,
+            bytes_received=api.bytes_sent - bytes_sent,
+            seconds=elapsed,
+            cpu_seconds=cpu,
+        )
+    api.conditional = True
+    return results
+
+
+def run_scenario(name: str, func: Callable[[], dict]) -> dict:
+    logging.info(f"Running {name}")
+    return func()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the menstruation benchmarks")
+    parser.add_argument("--latency", type=float, default=0.02, help="API latency (s)")
+    parser.add_argument("--bot-latency", type=float, default=0.0)
+    parser.add_argument("--redis", help="Redis URL, fakeredis if omitted")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--subscribers", type=int, default=10_000)
+    parser.add_argument("--mensas", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=20, help="refreshes per menu")
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    api = FakeApi(latency=args.latency)
+    bot = FakeBot(latency=args.bot_latency)
+    config.endpoint = api.endpoint
+    config.moderators = []
+    config.user_db.redis, config.async_user_db.redis = make_redis(args.redis)
+    config.user_db.redis.flushdb()
+    sender.outbox = UnthrottledQueue()
+    user_ids = populate(args.subscribers, args.mensas)
+
+    results = dict(
+        send_menu_cold=run_scenario(
+            "send_menu (cold)", lambda: bench_send_menu(bot, args.iterations, True)
+        ),
+        send_menu_warm=run_scenario(
+            "send_menu (warm)", lambda: bench_send_menu(bot, args.iterations, False)
+        ),
+        menu_throughput=run_scenario(
+            "/menu throughput",
+            lambda: bench_menu_throughput(bot, args.requests),
+        ),
+        notification_burst=run_scenario(
+            "notification burst", lambda: bench_notification_burst(bot, user_ids)
+        ),
+        startup_rebuild=run_scenario(
+            "startup (rebuild)", lambda: bench_startup(bot, True)
+        ),
+        startup=run_scenario("startup", lambda: bench_startup(bot, False)),
+        revalidation=run_scenario(
+            "revalidation", lambda: bench_revalidation(api, args.mensas, args.rounds)
+        ),
+    )
+    report = dict(
+        timestamp=time(),
+        python=platform.python_version(),
+        parameters=vars(args),
+        upstream_requests=dict(api.requests),
+        results=results,
+    )
+    sender.outbox.stop()
+    runtime.loop.stop()
+    api.shutdown()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,14 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     Updater,
     Defaults,
 )
 from telegram.ext.filters import Filters
 
-from menstruation import config, jobs
+from menstruation import config, jobs, metrics, runtime, webhook
+from menstruation.sender import outbox
 from menstruation.handlers import (
     help_handler,
     menu_handler,
@@ -24,6 +26,7 @@ from menstruation.handlers import (
     status_handler,
     broadcast_handler,
     callback_handler,
+    inline_handler,
     chat_id_handler,
     debug_handler,
 )
@@ -32,46 +35,48 @@ from menstruation.handlers import (
 def run():
     bot = Updater(
         token=config.token,
-        workers=config.workers,
         defaults=Defaults(tzinfo=pytz.timezone("Europe/Berlin")),
     )
 
-    bot.dispatcher.add_handler(CommandHandler("help", help_handler, run_async=True))
-    bot.dispatcher.add_handler(CommandHandler("start", help_handler, run_async=True))
+    bot.dispatcher.add_handler(CommandHandler("help", help_handler))
+    bot.dispatcher.add_handler(CommandHandler("start", help_handler))
+    bot.dispatcher.add_handler(CommandHandler("menu", menu_handler, pass_args=True))
+    bot.dispatcher.add_handler(CommandHandler("mensa", mensa_handler, pass_args=True))
+    bot.dispatcher.add_handler(CommandHandler("allergens", allergens_handler))
+    bot.dispatcher.add_handler(CommandHandler("info", info_handler))
+    bot.dispatcher.add_handler(CommandHandler("resetallergens", resetallergens_handler))
     bot.dispatcher.add_handler(
-        CommandHandler("menu", menu_handler, pass_args=True, run_async=True)
+        CommandHandler("subscribe", subscribe_handler, pass_args=True)
     )
+    bot.dispatcher.add_handler(CommandHandler("unsubscribe", unsubscribe_handler))
+    bot.dispatcher.add_handler(CommandHandler("chatid", chat_id_handler))
+    bot.dispatcher.add_handler(CommandHandler("status", status_handler))
     bot.dispatcher.add_handler(
-        CommandHandler("mensa", mensa_handler, pass_args=True, run_async=True)
+        CommandHandler("broadcast", broadcast_handler, pass_args=True)
     )
-    bot.dispatcher.add_handler(
-        CommandHandler("allergens", allergens_handler, run_async=True)
-    )
-    bot.dispatcher.add_handler(CommandHandler("info", info_handler, run_async=True))
-    bot.dispatcher.add_handler(
-        CommandHandler("resetallergens", resetallergens_handler, run_async=True)
-    )
-    bot.dispatcher.add_handler(
-        CommandHandler("subscribe", subscribe_handler, pass_args=True, run_async=True)
-    )
-    bot.dispatcher.add_handler(
-        CommandHandler("unsubscribe", unsubscribe_handler, run_async=True)
-    )
-    bot.dispatcher.add_handler(
-        CommandHandler("chatid", chat_id_handler, run_async=True)
-    )
-    bot.dispatcher.add_handler(CommandHandler("status", status_handler, run_async=True))
-    bot.dispatcher.add_handler(
-        CommandHandler("broadcast", broadcast_handler, pass_args=True, run_async=True)
-    )
-    bot.dispatcher.add_handler(CommandHandler("debug", debug_handler, run_async=True))
+    bot.dispatcher.add_handler(CommandHandler("debug", debug_handler))
     bot.dispatcher.add_handler(CallbackQueryHandler(callback_handler))
+    bot.dispatcher.add_handler(InlineQueryHandler(inline_handler))
     bot.dispatcher.add_handler(MessageHandler(Filters.command, help_handler))
 
     job_queue = bot.job_queue
     jobs.setup_job_queue(job_queue)
 
-    logging.info("Bot is ready")
+    metrics_server = metrics.start_server(config.metrics_listen, config.metrics_port)
+    logging.info(f"Bot is ready ({config.mode})")
 
-    bot.start_polling()
+    webhook_server = None
+    if config.mode == "webhook":
+        webhook_server = webhook.start_webhook(bot)
+    elif config.mode == "polling":
+        bot.start_polling()
+    else:
+        webhook.start_dispatcher(bot)
     bot.idle()
+    if webhook_server:
+        webhook_server.shutdown()
+    if metrics_server:
+        metrics_server.shutdown()
+    jobs.release_partitions()
+    outbox.stop()
+    runtime.loop.stop()
@@ -0,0 +1,208 @@
+import logging
+import uuid
+from concurrent.futures import Future, wait
+from time import monotonic
+from typing import Dict, List
+
+from emoji import emojize
+from redis.exceptions import LockNotOwnedError
+from redis.lock import Lock
+from telegram import Bot
+from telegram.error import Unauthorized
+from telegram.ext import CallbackContext, JobQueue
+
+from menstruation import config, sender
+
+user_db = config.user_db
+
+BROADCASTS_KEY = "broadcasts"
+BATCH_SIZE = 100
+PROGRESS_INTERVAL = 5
+SENT_RETENTION = 7 * 24 * 3600
+LOCK_TIMEOUT = 120
+
+
+def broadcast_key(broadcast_id: str) -> str:
+    return f"broadcast:{broadcast_id}"
+
+
+def sent_key(broadcast_id: str) -> str:
+    return f"broadcast:{broadcast_id}:sent"
+
+
+def start_broadcast(job_queue: JobQueue, bot: Bot, moderator: int, text: str) -> str:
+    broadcast_id = uuid.uuid4().hex
+    total = recipient_count(moderator)
+    status_message = sender.send_message(
+        bot, moderator, render_progress(0, 0, total)
+    ).result()
+    pipeline = user_db.redis.pipeline()
+    pipeline.hset(
+        broadcast_key(broadcast_id),
+        mapping=dict(
+            text=text,
+            moderator=str(moderator),
+            status_message_id=str(status_message.message_id),
+            cursor="0",
+            total=str(total),
+            sent="0",
+            failed="0",
+        ),
+    )
+    pipeline.sadd(BROADCASTS_KEY, broadcast_id)
+    pipeline.execute()
+    logging.info(f"Started broadcast {broadcast_id} to {total} users")
+    job_queue.run_once(run_broadcast, 0, context=broadcast_id, name="broadcast")
+    return broadcast_id
+
+
+def recipient_count(moderator: int) -> int:
+    pipeline = user_db.redis.pipeline(transaction=False)
+    pipeline.scard(user_db.USERS_KEY)
+    pipeline.sismember(user_db.USERS_KEY, str(moderator))
+    users, moderator_is_user = pipeline.execute()
+    return users - int(moderator_is_user)
+
+
+def resume_broadcasts(job_queue: JobQueue) -> None:
+    for broadcast_id in user_db.redis.smembers(BROADCASTS_KEY):
+        logging.info(f"Resuming broadcast {broadcast_id}")
+        job_queue.run_once(run_broadcast, 0, context=broadcast_id, name="broadcast")
+
+
+def run_broadcast(context: CallbackContext):
+    broadcast_id: str = context.job.context
+    lock = user_db.redis.lock(
+        f"{broadcast_key(broadcast_id)}:lock", timeout=LOCK_TIMEOUT
+    )
+    if not lock.acquire(blocking=False):
+        logging.info(f"Broadcast {broadcast_id} is run by another instance")
+        return
+    try:
+        send_broadcast(context.bot, broadcast_id, lock)
+    except LockNotOwnedError:
+        logging.warning(
+            f"Lost the lock on broadcast {broadcast_id}, "
+            f"leaving it to another instance"
+        )
+        context.job_queue.run_once(
+            run_broadcast, LOCK_TIMEOUT, context=broadcast_id, name="broadcast"
+        )
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            pass
+
+
+def send_broadcast(bot: Bot, broadcast_id: str, lock: Lock):
+    state = user_db.redis.hgetall(broadcast_key(broadcast_id))
+    if not state:
+        logging.info(f"Broadcast {broadcast_id} is already finished")
+        user_db.redis.srem(BROADCASTS_KEY, broadcast_id)
+        return
+    moderator = int(state["moderator"])
+    status_message_id = int(state["status_message_id"])
+    text = state["text"]
+    total = int(state["total"])
+    cursor = int(state["cursor"])
+    sent = int(state["sent"])
+    failed = int(state["failed"])
+    last_progress = monotonic()
+    while True:
+        cursor, user_id_strs = user_db.redis.sscan(
+            user_db.USERS_KEY, cursor, count=BATCH_SIZE
+        )
+        batch = pending_recipients(broadcast_id, user_id_strs, moderator)
+        deliveries = {
+            user_id: sender.send_message(bot, user_id, text, priority=sender.BULK)
+            for user_id in batch
+        }
+        await_deliveries(deliveries, lock)
+        delivered = []
+        for user_id, delivery in deliveries.items():
+            try:
+                delivery.result()
+                delivered.append(user_id)
+            except Unauthorized:
+                logging.info(f"Removed {user_id}, because they blocked the bot")
+                user_db.remove_user(user_id)
+                failed += 1
+            except Exception as err:
+                logging.exception(f"Broadcast to {user_id} failed: {err}")
+                failed += 1
+        sent += len(delivered)
+        pipeline = user_db.redis.pipeline()
+        if delivered:
+            pipeline.sadd(sent_key(broadcast_id), *map(str, delivered))
+        pipeline.hset(
+            broadcast_key(broadcast_id),
+            mapping=dict(cursor=str(cursor), sent=str(sent), failed=str(failed)),
+        )
+        pipeline.execute()
+        lock.reacquire()
+        if cursor == 0:
+            break
+        if monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = monotonic()
+            update_progress(bot, moderator, status_message_id, sent, failed, total)
+    update_progress(bot, moderator, status_message_id, sent, failed, total, done=True)
+    pipeline = user_db.redis.pipeline()
+    pipeline.srem(BROADCASTS_KEY, broadcast_id)
+    pipeline.delete(broadcast_key(broadcast_id))
+    pipeline.expire(sent_key(broadcast_id), SENT_RETENTION)
+    pipeline.execute()
+    logging.info(f"Broadcast {broadcast_id} finished: {sent} sent, {failed} failed")
+
+
+def await_deliveries(deliveries: Dict[int, Future], lock: Lock) -> None:
+    # Bulk messages queue behind notifications, so a batch can take longer
+    # than LOCK_TIMEOUT to go out.
+    pending = set(deliveries.values())
+    while pending:
+        _, pending = wait(pending, timeout=LOCK_TIMEOUT / 3)
+        lock.reacquire()
+
+
+def pending_recipients(
+    broadcast_id: str, user_id_strs: List[str], moderator: int
+) -> List[int]:
+    user_ids = [int(user_id_str) for user_id_str in user_id_strs]
+    user_ids = [user_id for user_id in user_ids if user_id != moderator]
+    pipeline = user_db.redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipeline.sismember(sent_key(broadcast_id), str(user_id))
+    return [
+        user_id for user_id, is_sent in zip(user_ids, pipeline.execute()) if not is_sent
+    ]
+
+
+def render_progress(sent: int, failed: int, total: int, done: bool = False) -> str:
+    if done:
+        return emojize(
+            f"Broadcast erfolgreich versendet. :thumbs_up:\n"
+            f"Zugestellt: {sent}, fehlgeschlagen: {failed}"
+        )
+    return emojize(
+        f"Broadcast wird versendet… :hourglass_not_done:\n"
+        f"{sent + failed} / {total} (fehlgeschlagen: {failed})"
+    )
+
+
+def update_progress(
+    bot: Bot,
+    moderator: int,
+    message_id: int,
+    sent: int,
+    failed: int,
+    total: int,
+    done: bool = False,
+) -> None:
+    sender.outbox.submit(
+        moderator,
+        sender.INTERACTIVE,
+        bot.edit_message_text,
+        render_progress(sent, failed, total, done),
+        chat_id=moderator,
+        message_id=message_id,
+    )
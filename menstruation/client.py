@@ -1,11 +1,344 @@
+import asyncio
+import bisect
+import difflib
+import functools
+import itertools
+import json
 import logging
-from typing import Dict
+import re
+import threading
+import unicodedata
+from concurrent.futures import Future
+from datetime import date
+from time import monotonic, time
+from typing import Any, Dict, List, Set, Optional, Tuple, Union
+from urllib.parse import urlsplit
 
-import requests
-from cachetools import cached, TTLCache
+import httpx
+import redis
+from cachetools import LRUCache
 
+from menstruation import config, metrics, runtime
 from menstruation.query import Color, Tag, Query
 
+RETRIES = 2
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = (500, 502, 503, 504)
+
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def session() -> httpx.AsyncClient:
+    # created lazily, so that it belongs to the event loop it is used on
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+            limits=httpx.Limits(max_keepalive_connections=config.http_pool_size),
+        )
+    return http_client
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+    FAILURE_THRESHOLD = 5
+    RESET_TIMEOUT = 30
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before(self) -> None:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                if monotonic() - self.opened_at < self.RESET_TIMEOUT:
+                    raise CircuitOpenError(f"Circuit for {self.name} is open")
+                logging.info(f"Circuit for {self.name} is half-open")
+                self.state = self.HALF_OPEN
+            if self.trial_running:
+                raise CircuitOpenError(f"Circuit for {self.name} is half-open")
+            self.trial_running = True
+
+    def succeeded(self) -> None:
+        with self.lock:
+            if self.state != self.CLOSED:
+                logging.info(f"Circuit for {self.name} closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def failed(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.FAILURE_THRESHOLD
+            ):
+                logging.warning(
+                    f"Circuit for {self.name} opened after {self.failures} failures"
+                )
+                self.state = self.OPEN
+                self.opened_at = monotonic()
+
+    def is_closed(self) -> bool:
+        with self.lock:
+            return self.state == self.CLOSED
+
+    def describe(self) -> str:
+        with self.lock:
+            if self.state == self.OPEN:
+                retry_in = max(0, self.RESET_TIMEOUT - (monotonic() - self.opened_at))
+                return f"{self.state}, nächster Versuch in {retry_in:.0f}s"
+            return f"{self.state} ({self.failures} Fehler)"
+
+
+breakers: Dict[str, CircuitBreaker] = dict()
+breakers_lock = threading.Lock()
+
+
+def breaker_for(url: str) -> CircuitBreaker:
+    path = urlsplit(url).path or "/"
+    with breakers_lock:
+        if path not in breakers:
+            breakers[path] = CircuitBreaker(path)
+        return breakers[path]
+
+
+def breaker_status() -> str:
+    with breakers_lock:
+        current = sorted(breakers.items())
+    return "\n".join(f"{path}: {breaker.describe()}" for path, breaker in current)
+
+
+async def request(url: str, **kwargs) -> httpx.Response:
+    attempt = 0
+    while True:
+        try:
+            response = await session().get(url, **kwargs)
+        except httpx.TransportError:
+            if attempt >= RETRIES:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= RETRIES:
+                return response
+        await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+        attempt += 1
+
+
+async def get(url: str, **kwargs) -> Tuple[httpx.Response, Any]:
+    breaker = breaker_for(url)
+    breaker.before()
+    try:
+        with metrics.upstream_duration.labels(urlsplit(url).path or "/").time():
+            response = await request(url, **kwargs)
+    except httpx.HTTPError as err:
+        breaker.failed()
+        raise UpstreamError(f"{url}: {err!r}") from err
+    if response.status_code >= 500:
+        breaker.failed()
+        raise UpstreamError(f"{url} answered {response.status_code}")
+    healthy = True
+    try:
+        body = None if response.status_code == 304 else response.json()
+    except ValueError:
+        # a maintenance page served with 200 means the API is down, too
+        healthy = response.is_error
+        raise
+    finally:
+        if healthy:
+            breaker.succeeded()
+        else:
+            breaker.failed()
+    return response, body
+
+
+def all_done(futures: List[Future]) -> Future:
+    done: Future = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(_: Future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        done.set_result(futures)
+
+    if not futures:
+        done.set_result(futures)
+    for future in futures:
+        future.add_done_callback(finished)
+    return done
+
+
+class SharedCache(object):
+    PREFIX = "cache:v2:"
+    MAX_STALE = 24 * 3600
+
+    def __init__(self, name: str, ttl: int, maxsize: int) -> None:
+        self.name = name
+        self.ttl = ttl
+        # entries are read and written on the event loop, but cleared and
+        # evicted from other threads, too
+        self.entries: LRUCache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+        self.loading: Dict[str, asyncio.Future] = dict()
+        self.refreshing: Dict[str, asyncio.Future] = dict()
+        self.requests = functools.partial(metrics.cache_requests.labels, name)
+
+    def get(self, url: str):
+        return self.get_entry(url)["body"]
+
+    def get_entry(self, url: str) -> dict:
+        return runtime.loop.call(self.get_entry_async(url))
+
+    async def get_entry_async(self, url: str) -> dict:
+        return await self.revalidate(url, await self.lookup(url))
+
+    async def lookup(self, url: str) -> dict:
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is not None:
+            self.requests("hit").inc()
+            return entry
+        loading = self.loading.get(url)
+        if loading is None:
+            loading = self.loading[url] = asyncio.ensure_future(self.load(url))
+            loading.add_done_callback(functools.partial(self.loaded, url))
+        else:
+            self.requests("hit").inc()
+        return await asyncio.shield(loading)
+
+    def loaded(self, url: str, loading: asyncio.Future) -> None:
+        del self.loading[url]
+        if not loading.cancelled() and loading.exception() is None:
+            with self.lock:
+                self.entries[url] = loading.result()
+
+    async def revalidate(self, url: str, entry: dict) -> dict:
+        age = time() - entry["fetched_at"]
+        if age >= self.ttl + self.MAX_STALE:
+            self.evict(url)
+            try:
+                entry = await self.lookup(url)
+            except CircuitOpenError:
+                logging.debug(f"Serving last known good copy of {url}")
+                self.requests("stale").inc()
+        elif age >= self.ttl:
+            self.requests("stale").inc()
+            self.refresh_in_background(url)
+        return entry
+
+    async def load(self, url: str) -> dict:
+        try:
+            fields = await config.async_user_db.redis.hgetall(self.PREFIX + url)
+        except redis.RedisError as err:
+            logging.warning(f"Shared cache unavailable: {err}")
+            fields = dict()
+        if "body" in fields:
+            logging.debug(f"Shared cache hit for {url}")
+            self.requests("shared").inc()
+            return dict(
+                fetched_at=float(fields["fetched_at"]),
+                body=json.loads(fields["body"]),
+                etag=fields.get("etag"),
+                last_modified=fields.get("last_modified"),
+            )
+        self.requests("miss").inc()
+        return await self.fetch(url)
+
+    async def fetch(self, url: str, previous: Optional[dict] = None) -> dict:
+        headers = dict()
+        if previous and previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous and previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+        response, body = await get(url, headers=headers)
+        logging.debug(f"Requesting {response.url}, status_code: {response.status_code}")
+        if previous and headers and response.status_code == 304:
+            self.requests("not_modified").inc()
+            entry = dict(previous, fetched_at=time())
+            await self.store(url, entry, body_changed=False)
+            return entry
+        entry = dict(
+            fetched_at=time(),
+            body=body,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+        await self.store(url, entry, body_changed=True)
+        return entry
+
+    async def store(self, url: str, entry: dict, body_changed: bool) -> None:
+        key = self.PREFIX + url
+        fields = dict(fetched_at=str(entry["fetched_at"]))
+        if body_changed:
+            fields["body"] = json.dumps(entry["body"])
+            for validator in ("etag", "last_modified"):
+                if entry[validator]:
+                    fields[validator] = entry[validator]
+        try:
+            pipeline = config.async_user_db.redis.pipeline()
+            if body_changed:
+                pipeline.delete(key)
+            pipeline.hset(key, mapping=fields)
+            pipeline.expire(key, self.ttl + self.MAX_STALE)
+            await pipeline.execute()
+        except redis.RedisError as err:
+            logging.warning(f"Shared cache unavailable: {err}")
+
+    def evict(self, url: str) -> None:
+        with self.lock:
+            self.entries.pop(url, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def refresh_in_background(self, url: str) -> None:
+        if url not in self.refreshing:
+            self.refreshing[url] = asyncio.ensure_future(self.refresh(url))
+
+    async def refresh(self, url: str) -> None:
+        try:
+            with self.lock:
+                previous = self.entries.get(url)
+            entry = await self.fetch(url, previous)
+            with self.lock:
+                self.entries[url] = entry
+            logging.debug(f"Refreshed {self.name} cache for {url}")
+        except CircuitOpenError as err:
+            logging.debug(f"Not refreshing {url}: {err}")
+        except Exception as err:
+            logging.warning(f"Refreshing {url} failed, serving stale copy: {err}")
+        finally:
+            self.refreshing.pop(url, None)
+
+
+menu_cache = SharedCache("menu", ttl=450, maxsize=512)
+allergens_cache = SharedCache("allergens", ttl=3600, maxsize=1)
+codes_cache = SharedCache("codes", ttl=3600, maxsize=1)
+
+
+def prepare_url(url: str, params: Optional[dict] = None) -> str:
+    return str(httpx.URL(url, params=params))
+
 
 def render_cents(total_cents: int):
     euros = total_cents // 100
@@ -34,27 +367,51 @@ def render_group(group):
         return ""
 
 
-@cached(cache=TTLCache(maxsize=512, ttl=450))
-def get_json_cached(url: str):
-    response = requests.get(url=url)
-    logging.debug(f"Requesting {response.url}, status_code: {response.status_code}")
-    return response.json()
+class StaleMenu(list):
+    def __init__(self, groups: list, fetched_at: float) -> None:
+        super().__init__(groups)
+        self.fetched_at = fetched_at
 
 
-def get_json(endpoint: str, mensa_code: int, query: Query) -> dict:
-    url = f"{endpoint}/menu"
-    request = requests.Request(
-        "GET", url, params=dict(mensa=str(mensa_code), **query.params())
-    ).prepare()
-    return get_json_cached(request.url or url)
+def filter_menu(url: str, query: Query, entry: dict) -> list:
+    groups = query.filter(entry["body"])
+    if (
+        time() - entry["fetched_at"] >= menu_cache.ttl
+        and not breaker_for(url).is_closed()
+    ):
+        return StaleMenu(groups, entry["fetched_at"])
+    return groups
 
 
-@cached(cache=TTLCache(maxsize=1, ttl=3600))
-def get_allergens(endpoint: str) -> Dict[str, str]:
-    response = requests.get(f"{endpoint}/allergens")
-    logging.debug(f"Requesting {response.url}")
+def menu_url(endpoint: str, mensa_code: int, query: Query) -> str:
+    return prepare_url(
+        f"{endpoint}/menu",
+        params=dict(mensa=str(mensa_code), date=query.effective_date().isoformat()),
+    )
+
+
+def get_json(endpoint: str, mensa_code: int, query: Query) -> list:
+    return runtime.loop.call(get_json_async(endpoint, mensa_code, query))
+
+
+async def get_json_async(endpoint: str, mensa_code: int, query: Query) -> list:
+    url = menu_url(endpoint, mensa_code, query)
+    return filter_menu(url, query, await menu_cache.get_entry_async(url))
+
+
+async def get_json_range_async(
+    endpoint: str, mensa_code: int, query: Query
+) -> List[Tuple[date, Union[list, Exception]]]:
+    days = query.dates()
+    menus = await runtime.gather(
+        get_json_async(endpoint, mensa_code, query.on(day)) for day in days
+    )
+    return list(zip(days, menus))
+
+
+def allergen_names(allergens: dict) -> Dict[str, str]:
     number_name = dict()
-    for allergen in response.json()["items"]:
+    for allergen in allergens["items"]:
         number = (
             f"{allergen['number']}"
             f"{allergen['index'] if allergen['index'] is not None else ''}"
@@ -63,13 +420,80 @@ def get_allergens(endpoint: str) -> Dict[str, str]:
     return number_name
 
 
-@cached(cache=TTLCache(maxsize=64, ttl=3600))
+def get_allergens(endpoint: str) -> Dict[str, str]:
+    return runtime.loop.call(get_allergens_async(endpoint))
+
+
+async def get_allergens_async(endpoint: str) -> Dict[str, str]:
+    entry = await allergens_cache.get_entry_async(f"{endpoint}/allergens")
+    return allergen_names(entry["body"])
+
+
+def normalize(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKD", text.casefold().replace("ß", "ss"))
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r"\w+", text)
+
+
+class MensaIndex(object):
+    FUZZY_CUTOFF = 0.75
+
+    def __init__(self, universities: List[dict]) -> None:
+        self.code_name: Dict[int, str] = dict()
+        postings: Dict[str, Set[int]] = dict()
+        for uni in universities:
+            for mensa in uni["items"]:
+                if "Coffeebar" in mensa["name"]:
+                    continue
+                self.code_name[mensa["code"]] = mensa["name"]
+                for token in normalize(f"{uni['name']} {mensa['name']}"):
+                    postings.setdefault(token, set()).add(mensa["code"])
+        self.postings = postings
+        self.vocabulary = sorted(postings)
+
+    def lookup(self, token: str) -> Set[int]:
+        codes: Set[int] = set()
+        start = bisect.bisect_left(self.vocabulary, token)
+        for word in itertools.islice(self.vocabulary, start, None):
+            if not word.startswith(token):
+                break
+            codes |= self.postings[word]
+        if not codes:
+            for word in difflib.get_close_matches(
+                token, self.vocabulary, n=3, cutoff=self.FUZZY_CUTOFF
+            ):
+                codes |= self.postings[word]
+        return codes
+
+    def search(self, pattern: str) -> Dict[int, str]:
+        tokens = normalize(pattern)
+        if not tokens:
+            return self.code_name
+        codes = set.intersection(*(self.lookup(token) for token in tokens))
+        return {code: name for code, name in self.code_name.items() if code in codes}
+
+
+mensa_indices: Dict[str, Tuple[object, MensaIndex]] = dict()
+mensa_indices_lock = threading.Lock()
+
+
+def codes_url(endpoint: str) -> str:
+    return prepare_url(f"{endpoint}/codes", {"pattern": ""})
+
+
+def mensa_index(endpoint: str, universities: List[dict]) -> MensaIndex:
+    with mensa_indices_lock:
+        source, index = mensa_indices.get(endpoint, (None, None))
+        if source is not universities:
+            index = MensaIndex(universities)
+            mensa_indices[endpoint] = universities, index
+        return index
+
+
 def get_mensas(endpoint: str, pattern: str = "") -> Dict[int, str]:
-    response = requests.get(f"{endpoint}/codes", params={"pattern": pattern})
-    logging.debug(f"Requesting {response.url}")
-    code_name = dict()
-    for uni in response.json():
-        for mensa in uni["items"]:
-            if "Coffeebar" not in mensa["name"]:
-                code_name[mensa["code"]] = mensa["name"]
-    return code_name
+    return runtime.loop.call(get_mensas_async(endpoint, pattern))
+
+
+async def get_mensas_async(endpoint: str, pattern: str = "") -> Dict[int, str]:
+    entry = await codes_cache.get_entry_async(codes_url(endpoint))
+    return mensa_index(endpoint, entry["body"]).search(pattern)
@@ -2,9 +2,13 @@ import logging
 import os
 import sys
 from datetime import time, datetime
-from typing import Set, Optional, List
+from itertools import islice
+from typing import Set, Optional, List, Dict, Iterable, Iterator
 
 import redis
+import redis.asyncio
+
+from menstruation import metrics
 
 
 def set_logging_level():
@@ -15,59 +19,351 @@ def set_logging_level():
     logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
 
 
+def minute_of_day(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+
+def is_user_key(key: str) -> bool:
+    return key.lstrip("-").isdigit()
+
+
+class UserProfile(object):
+    def __init__(
+        self,
+        user_id: int,
+        allergens: Set[str],
+        mensa: Optional[int],
+        subscribed: bool,
+        subscription_time: Optional[time],
+        menu_filter: Optional[str],
+    ) -> None:
+        self.user_id = user_id
+        self.allergens = allergens
+        self.mensa = mensa
+        self.subscribed = subscribed
+        self.subscription_time = subscription_time
+        self.menu_filter = menu_filter
+
+    @property
+    def notification_time(self) -> time:
+        return self.subscription_time or notification_time
+
+    @staticmethod
+    def from_hash(
+        user_id: int, fields: Dict[str, str], allergens: Set[str]
+    ) -> "UserProfile":
+        mensa = fields.get("mensa")
+        subscription_time = fields.get("subscription_time")
+        return UserProfile(
+            user_id=user_id,
+            allergens=allergens,
+            mensa=int(mensa) if mensa is not None else None,
+            subscribed=fields.get("subscribed") == "yes",
+            subscription_time=datetime.strptime(subscription_time, "%H:%M").time()
+            if subscription_time
+            else None,
+            menu_filter=fields.get("menu_filter"),
+        )
+
+
+def allergens_key(user_id: int) -> str:
+    return f"{user_id}:allergens"
+
+
+TOGGLE_SCRIPT = """
+if redis.call("srem", KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+redis.call("sadd", KEYS[1], ARGV[1])
+redis.call("sadd", KEYS[2], ARGV[2])
+return 1
+"""
+
+
+# The queue_* helpers add the commands to a pipeline, so that UserDatabase and
+# AsyncUserDatabase share them and only differ in how the pipeline is run.
+def queue_profile(pipeline, user_id: int) -> None:
+    pipeline.hgetall(str(user_id))
+    pipeline.smembers(allergens_key(user_id))
+
+
+def queue_field(pipeline, user_id: int, field: str, value: str) -> None:
+    pipeline.hset(str(user_id), field, value)
+    pipeline.sadd(UserDatabase.USERS_KEY, str(user_id))
+
+
+def queue_subscription(pipeline, user_id: int, subscribed: bool) -> None:
+    pipeline.hset(str(user_id), "subscribed", "yes" if subscribed else "no")
+    pipeline.sadd(UserDatabase.USERS_KEY, str(user_id))
+    if subscribed:
+        pipeline.sadd(UserDatabase.SUBSCRIBERS_KEY, str(user_id))
+    else:
+        pipeline.srem(UserDatabase.SUBSCRIBERS_KEY, str(user_id))
+
+
+def queue_schedule(pipeline, user_id: int, t: Optional[time]) -> None:
+    if t is None:
+        pipeline.zrem(UserDatabase.SCHEDULE_KEY, str(user_id))
+        pipeline.sadd(UserDatabase.DEFAULT_SCHEDULE_KEY, str(user_id))
+    else:
+        pipeline.srem(UserDatabase.DEFAULT_SCHEDULE_KEY, str(user_id))
+        pipeline.zadd(UserDatabase.SCHEDULE_KEY, {str(user_id): minute_of_day(t)})
+
+
+def queue_unschedule(pipeline, user_id: int) -> None:
+    pipeline.zrem(UserDatabase.SCHEDULE_KEY, str(user_id))
+    pipeline.srem(UserDatabase.DEFAULT_SCHEDULE_KEY, str(user_id))
+
+
+def queue_scheduled_count(pipeline) -> None:
+    pipeline.zcard(UserDatabase.SCHEDULE_KEY)
+    pipeline.scard(UserDatabase.DEFAULT_SCHEDULE_KEY)
+
+
 class UserDatabase(object):
+    SCHEDULE_KEY = "schedule"
+    DEFAULT_SCHEDULE_KEY = "schedule:default"
+    USERS_KEY = "users"
+    SUBSCRIBERS_KEY = "subscribers"
+    SCHEMA_KEY = "schema_version"
+    SCHEMA_VERSION = 3
+    BATCH_SIZE = 500
+
     def __init__(self, host: str) -> None:
         self.redis = redis.Redis(host, decode_responses=True)
+        self.toggle_script = self.redis.register_script(TOGGLE_SCRIPT)
 
-    def allergens_of(self, user_id: int) -> Set[str]:
-        value = self.redis.hget(str(user_id), "allergens")
-        if value is not None:
-            return set(value.split(","))
-        else:
-            return set()
+    @metrics.timed(metrics.redis_duration)
+    def profile_of(self, user_id: int) -> UserProfile:
+        pipeline = self.redis.pipeline(transaction=False)
+        queue_profile(pipeline, user_id)
+        fields, allergens = pipeline.execute()
+        return UserProfile.from_hash(user_id, fields, allergens)
 
-    def set_allergens_for(self, user_id: int, allergens: Set[str]) -> None:
-        self.redis.hset(str(user_id), "allergens", ",".join(allergens))
+    @metrics.timed(metrics.redis_duration)
+    def profiles(self, user_ids: Iterable[int]) -> List[UserProfile]:
+        user_ids = list(user_ids)
+        pipeline = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            queue_profile(pipeline, user_id)
+        results = pipeline.execute()
+        return [
+            UserProfile.from_hash(user_id, fields, allergens)
+            for user_id, fields, allergens in zip(user_ids, results[::2], results[1::2])
+        ]
 
-    def reset_allergens_for(self, user_id: int) -> None:
-        self.redis.hdel(str(user_id), "allergens")
+    @metrics.timed(metrics.redis_duration)
+    def set_field(self, user_id: int, field: str, value: str) -> None:
+        pipeline = self.redis.pipeline(transaction=False)
+        queue_field(pipeline, user_id, field, value)
+        pipeline.execute()
 
-    def mensa_of(self, user_id: int) -> Optional[int]:
-        value = self.redis.hget(str(user_id), "mensa")
-        if value is not None:
-            return int(value)
-        else:
-            return None
+    @metrics.timed(metrics.redis_duration)
+    def toggle_allergen(self, user_id: int, allergen: str) -> bool:
+        return bool(
+            self.toggle_script(
+                keys=[allergens_key(user_id), self.USERS_KEY],
+                args=[allergen, str(user_id)],
+                client=self.redis,
+            )
+        )
 
-    def set_mensa_for(self, user_id: int, mensa_str: str) -> None:
-        self.redis.hset(str(user_id), "mensa", mensa_str)
+    @metrics.timed(metrics.redis_duration)
+    def reset_allergens_for(self, user_id: int) -> None:
+        self.redis.delete(allergens_key(user_id))
 
-    def is_subscriber(self, user_id: int) -> bool:
-        return self.redis.hget(str(user_id), "subscribed") == "yes"
+    def set_mensa_for(self, user_id: int, mensa_str: str) -> None:
+        self.set_field(user_id, "mensa", mensa_str)
 
+    @metrics.timed(metrics.redis_duration)
     def set_subscription(self, user_id: int, subscribed: bool) -> None:
-        self.redis.hset(str(user_id), "subscribed", "yes" if subscribed else "no")
-
-    def subscription_time_of(self, user_id: int) -> Optional[time]:
-        user_time = self.redis.hget(str(user_id), "subscription_time")
-        return datetime.strptime(user_time, "%H:%M").time() if user_time else None
+        pipeline = self.redis.pipeline()
+        queue_subscription(pipeline, user_id, subscribed)
+        pipeline.execute()
 
     def set_subscription_time(self, user_id: int, t: time) -> None:
-        self.redis.hset(str(user_id), "subscription_time", t.strftime("%H:%M"))
-
-    def menu_filter_of(self, user_id: int) -> Optional[str]:
-        return self.redis.hget(str(user_id), "menu_filter")
+        self.set_field(user_id, "subscription_time", t.strftime("%H:%M"))
 
     def set_menu_filter(self, user_id: int, menu_filter: str) -> None:
-        self.redis.hset(str(user_id), "menu_filter", menu_filter)
+        self.set_field(user_id, "menu_filter", menu_filter)
+
+    @metrics.timed(metrics.redis_duration)
+    def schedule(self, user_id: int, t: Optional[time]) -> None:
+        pipeline = self.redis.pipeline()
+        queue_schedule(pipeline, user_id, t)
+        pipeline.execute()
+
+    @metrics.timed(metrics.redis_duration)
+    def unschedule(self, user_id: int) -> None:
+        pipeline = self.redis.pipeline()
+        queue_unschedule(pipeline, user_id)
+        pipeline.execute()
 
-    def users(self) -> List[int]:
-        return [int(user_id_str) for user_id_str in self.redis.keys()]
+    @metrics.timed(metrics.redis_duration)
+    def scheduled_between(self, start: time, end: time) -> List[int]:
+        # Users without a subscription time are kept apart from the schedule
+        # so that they follow the configured default when it changes.
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.zrangebyscore(
+            self.SCHEDULE_KEY, minute_of_day(start), minute_of_day(end)
+        )
+        if start <= notification_time <= end:
+            pipeline.smembers(self.DEFAULT_SCHEDULE_KEY)
+        return [
+            int(user_id_str)
+            for user_id_strs in pipeline.execute()
+            for user_id_str in user_id_strs
+        ]
+
+    @metrics.timed(metrics.redis_duration)
+    def scheduled_count(self) -> int:
+        pipeline = self.redis.pipeline(transaction=False)
+        queue_scheduled_count(pipeline)
+        return sum(pipeline.execute())
+
+    def iter_users(self) -> Iterator[int]:
+        for user_id_str in self.redis.scan_iter(count=self.BATCH_SIZE):
+            if is_user_key(user_id_str):
+                yield int(user_id_str)
+
+    @metrics.timed(metrics.redis_duration)
+    def user_count(self) -> int:
+        return self.redis.scard(self.USERS_KEY)
+
+    @metrics.timed(metrics.redis_duration)
+    def subscriber_count(self) -> int:
+        return self.redis.scard(self.SUBSCRIBERS_KEY)
+
+    @metrics.timed(metrics.redis_duration)
+    def schema_version(self) -> int:
+        return int(self.redis.get(self.SCHEMA_KEY) or 1)
 
+    def set_schema_version(self, version: int) -> None:
+        self.redis.set(self.SCHEMA_KEY, str(version))
+
+    @metrics.timed(metrics.redis_duration)
+    def has_index(self) -> bool:
+        return bool(self.redis.exists(self.USERS_KEY))
+
+    @metrics.timed(metrics.redis_duration)
+    def rebuild_index(self) -> None:
+        self.redis.delete(
+            self.USERS_KEY,
+            self.SUBSCRIBERS_KEY,
+            self.SCHEDULE_KEY,
+            self.DEFAULT_SCHEDULE_KEY,
+        )
+        user_ids = self.iter_users()
+        while True:
+            batch = list(islice(user_ids, self.BATCH_SIZE))
+            if not batch:
+                break
+            pipeline = self.redis.pipeline(transaction=False)
+            for profile in self.profiles(batch):
+                pipeline.sadd(self.USERS_KEY, str(profile.user_id))
+                if profile.subscribed:
+                    pipeline.sadd(self.SUBSCRIBERS_KEY, str(profile.user_id))
+                    if profile.subscription_time is None:
+                        pipeline.sadd(self.DEFAULT_SCHEDULE_KEY, str(profile.user_id))
+                    else:
+                        pipeline.zadd(
+                            self.SCHEDULE_KEY,
+                            {
+                                str(profile.user_id): minute_of_day(
+                                    profile.subscription_time
+                                )
+                            },
+                        )
+            pipeline.execute()
+
+    @metrics.timed(metrics.redis_duration)
     def remove_user(self, user_id: int) -> int:
-        return self.redis.hdel(
+        pipeline = self.redis.pipeline()
+        pipeline.hdel(
             str(user_id), "mensa", "subscribed", "subscription_time", "menu_filter"
         )
+        pipeline.delete(allergens_key(user_id))
+        pipeline.srem(self.USERS_KEY, str(user_id))
+        pipeline.srem(self.SUBSCRIBERS_KEY, str(user_id))
+        pipeline.zrem(self.SCHEDULE_KEY, str(user_id))
+        pipeline.srem(self.DEFAULT_SCHEDULE_KEY, str(user_id))
+        return pipeline.execute()[0]
+
+
+# The calls made while answering updates; they run on the event loop.
+class AsyncUserDatabase(object):
+    def __init__(self, host: str) -> None:
+        self.redis = redis.asyncio.Redis(host=host, decode_responses=True)
+        self.toggle_script = self.redis.register_script(TOGGLE_SCRIPT)
+
+    @metrics.timed(metrics.redis_duration)
+    async def profile_of(self, user_id: int) -> UserProfile:
+        pipeline = self.redis.pipeline(transaction=False)
+        queue_profile(pipeline, user_id)
+        fields, allergens = await pipeline.execute()
+        return UserProfile.from_hash(user_id, fields, allergens)
+
+    @metrics.timed(metrics.redis_duration)
+    async def set_field(self, user_id: int, field: str, value: str) -> None:
+        pipeline = self.redis.pipeline(transaction=False)
+        queue_field(pipeline, user_id, field, value)
+        await pipeline.execute()
+
+    @metrics.timed(metrics.redis_duration)
+    async def toggle_allergen(self, user_id: int, allergen: str) -> bool:
+        return bool(
+            await self.toggle_script(
+                keys=[allergens_key(user_id), UserDatabase.USERS_KEY],
+                args=[allergen, str(user_id)],
+                client=self.redis,
+            )
+        )
+
+    @metrics.timed(metrics.redis_duration)
+    async def reset_allergens_for(self, user_id: int) -> None:
+        await self.redis.delete(allergens_key(user_id))
+
+    async def set_mensa_for(self, user_id: int, mensa_str: str) -> None:
+        await self.set_field(user_id, "mensa", mensa_str)
+
+    @metrics.timed(metrics.redis_duration)
+    async def set_subscription(self, user_id: int, subscribed: bool) -> None:
+        pipeline = self.redis.pipeline()
+        queue_subscription(pipeline, user_id, subscribed)
+        await pipeline.execute()
+
+    @metrics.timed(metrics.redis_duration)
+    async def subscribe(
+        self, user_id: int, t: Optional[time], menu_filter: str
+    ) -> None:
+        pipeline = self.redis.pipeline()
+        if t is not None:
+            queue_field(pipeline, user_id, "subscription_time", t.strftime("%H:%M"))
+        queue_field(pipeline, user_id, "menu_filter", menu_filter)
+        queue_subscription(pipeline, user_id, True)
+        queue_schedule(pipeline, user_id, t)
+        await pipeline.execute()
+
+    @metrics.timed(metrics.redis_duration)
+    async def unsubscribe(self, user_id: int) -> None:
+        pipeline = self.redis.pipeline()
+        queue_subscription(pipeline, user_id, False)
+        queue_unschedule(pipeline, user_id)
+        await pipeline.execute()
+
+    @metrics.timed(metrics.redis_duration)
+    async def user_count(self) -> int:
+        return await self.redis.scard(UserDatabase.USERS_KEY)
+
+    @metrics.timed(metrics.redis_duration)
+    async def subscriber_count(self) -> int:
+        return await self.redis.scard(UserDatabase.SUBSCRIBERS_KEY)
+
+    @metrics.timed(metrics.redis_duration)
+    async def scheduled_count(self) -> int:
+        pipeline = self.redis.pipeline(transaction=False)
+        queue_scheduled_count(pipeline)
+        return sum(await pipeline.execute())
 
 
 try:
@@ -111,8 +407,72 @@ try:
 except (KeyError, ValueError):
     retries_api_failure = 5
 
+try:
+    http_pool_size = int(os.environ["MENSTRUATION_POOL_SIZE"])
+    if not http_pool_size:
+        raise KeyError
+except (KeyError, ValueError):
+    http_pool_size = workers
+
+try:
+    connect_timeout = float(os.environ["MENSTRUATION_CONNECT_TIMEOUT"])
+    if not connect_timeout:
+        raise KeyError
+except (KeyError, ValueError):
+    connect_timeout = 3.05
+
+try:
+    read_timeout = float(os.environ["MENSTRUATION_READ_TIMEOUT"])
+    if not read_timeout:
+        raise KeyError
+except (KeyError, ValueError):
+    read_timeout = 10.0
+
+try:
+    prewarm_minutes = int(os.environ["MENSTRUATION_PREWARM"])
+except (KeyError, ValueError):
+    prewarm_minutes = 5
+
+try:
+    partitions = int(os.environ["MENSTRUATION_PARTITIONS"])
+except (KeyError, ValueError):
+    partitions = 0
+
+try:
+    lease_ttl = int(os.environ["MENSTRUATION_LEASE_TTL"])
+    if not lease_ttl:
+        raise KeyError
+except (KeyError, ValueError):
+    lease_ttl = 30
+
+mode = os.environ.get("MENSTRUATION_MODE", "polling")
+if mode not in ("polling", "webhook", "none"):
+    print("MENSTRUATION_MODE must be one of polling, webhook or none.", file=sys.stderr)
+    sys.exit(1)
+
+webhook_listen = os.environ.get("MENSTRUATION_WEBHOOK_LISTEN", "127.0.0.1")
+
+try:
+    webhook_port = int(os.environ["MENSTRUATION_WEBHOOK_PORT"])
+    if not webhook_port:
+        raise KeyError
+except (KeyError, ValueError):
+    webhook_port = 8443
+
+webhook_path = os.environ.get("MENSTRUATION_WEBHOOK_PATH", "/telegram")
+webhook_secret = os.environ.get("MENSTRUATION_WEBHOOK_SECRET") or None
+webhook_url = os.environ.get("MENSTRUATION_WEBHOOK_URL") or None
+
+metrics_listen = os.environ.get("MENSTRUATION_METRICS_LISTEN", "127.0.0.1")
+
+try:
+    metrics_port = int(os.environ["MENSTRUATION_METRICS_PORT"])
+except (KeyError, ValueError):
+    metrics_port = 0
+
 debug = "MENSTRUATION_DEBUG" in os.environ
 
 set_logging_level()
 
 user_db = UserDatabase(redis_host)
+async_user_db = AsyncUserDatabase(redis_host)
@@ -1,30 +1,51 @@
 #!/usr/bin/env python3
+import asyncio
 import functools
 import logging
 import random
 import re
-from datetime import datetime
+from datetime import date, datetime
 from json import JSONDecodeError
-from time import sleep
+from typing import Dict, List, Tuple, Union
 
+from cachetools import TTLCache
 from emoji import emojize, demojize
-from telegram import Bot, Update
+from telegram import Bot, CallbackQuery, Update
 from telegram import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.error import Unauthorized
+from telegram import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import CallbackContext
 
 import menstruation.client as client
 from menstruation import config
-from menstruation import jobs
+from menstruation import broadcast, jobs, metrics, runtime, sender
+from menstruation.client import UpstreamError
 from menstruation.query import Query
 
-user_db = config.user_db
+user_db = config.async_user_db
 TIME_PATTERN = r"([01][0-9]|2[0-3]|[0-9]):[0-5][0-9]"
+MAX_MESSAGE_LENGTH = 4096
+UNAVAILABLE_CALLBACK_TEXT = "Die Mensa-API ist gerade nicht erreichbar."
+INLINE_DEBOUNCE = 0.4
+INLINE_CACHE_TIME = 30
+INLINE_RENDER_TTL = 60
+WEEKDAY_NAMES = [
+    "Montag",
+    "Dienstag",
+    "Mittwoch",
+    "Donnerstag",
+    "Freitag",
+    "Samstag",
+    "Sonntag",
+]
+
+# only touched on the event loop
+pending_inline: Dict[int, asyncio.Future] = dict()
+inline_cache: TTLCache = TTLCache(maxsize=1024, ttl=INLINE_RENDER_TTL)
 
 
 def debug_logging(func):
     @functools.wraps(func)
-    def wrapper_decorator(*args, **kwargs):
+    async def wrapper_decorator(*args, **kwargs):
         try:
             logging.debug(
                 f"Entering: {func.__name__}, "
@@ -33,14 +54,15 @@ def debug_logging(func):
             )
         except AttributeError:
             logging.debug(f"Entering: {func.__name__}")
-        func(*args, **kwargs)
+        with metrics.handler_duration.labels(func.__name__).time():
+            await func(*args, **kwargs)
         logging.debug(f"Exiting: {func.__name__}")
 
-    return wrapper_decorator
+    return runtime.handler(wrapper_decorator)
 
 
 @debug_logging
-def help_handler(update: Update, context: CallbackContext):
+async def help_handler(update: Update, context: CallbackContext):
     def infos(mapping):
         return "\n".join(k + " – " + v for k, v in mapping.items())
 
@@ -48,6 +70,7 @@ def help_handler(update: Update, context: CallbackContext):
         "/menu :seedling: 3€": "Heutige Speiseangebote (vegan bis 3€).",
         "/menu tomorrow": "Morgige Speiseangebote.",
         "/menu 2018-10-22": "Speiseangebote für den 22.10.2018.",
+        "/menu mo-fr": "Speiseangebote der Woche (auch „/menu week“ oder „/menu mi“).",
         "/help": "Dieser Hilfetext.",
         "/mensa beuth": "Auswahlmenü für die Mensen der Beuth Hochschule.",
         "/subscribe :carrot: 2€ 9:30": "Abonniere tägliche Benachrichtigungen der Speiseangebote "
@@ -78,7 +101,8 @@ def help_handler(update: Update, context: CallbackContext):
         ":green_heart:": "Lebensmittelampel grün",
         ":red_heart:": "Lebensmittelampel rot",
     }
-    context.bot.send_message(
+    sender.send_message(
+        context.bot,
         update.effective_message.chat_id,
         emojize(
             f"*BEFEHLE*\n{infos(command_description)}\n\n*LEGENDE*\n{infos(emoji_description)}"
@@ -87,60 +111,303 @@ def help_handler(update: Update, context: CallbackContext):
     )
 
 
-@debug_logging
-def send_menu(bot: Bot, chat_id: int, query: Query):
-    query.allergens = user_db.allergens_of(chat_id)
-    mensa_code = user_db.mensa_of(chat_id)
+def render_groups(json_object: list) -> str:
+    reply = "".join(client.render_group(group) for group in json_object)
+    if not reply:
+        reply = f"Kein Essen gefunden. {error_emoji()}"
+    return emojize(stale_notice(json_object) + reply)
+
+
+def stale_notice(menu: list) -> str:
+    if not isinstance(menu, client.StaleMenu):
+        return ""
+    fetched_at = datetime.fromtimestamp(menu.fetched_at)
+    return (
+        f":warning: Die Mensa-API ist gerade nicht erreichbar. "
+        f"Stand: {fetched_at.strftime('%d.%m. %H:%M')}\n\n"
+    )
+
+
+def unavailable_message() -> str:
+    return emojize(
+        f"Die Mensa-API ist gerade nicht erreichbar. {error_emoji()}\n"
+        f"Bitte versuche es später noch einmal."
+    )
+
+
+def unsupported_message() -> str:
+    return emojize(
+        f"Entweder ist diese Mensa noch nicht unterstützt, {error_emoji()}\n"
+        f"oder es gibt an diesem Tag dort kein Essen. {error_emoji()}"
+    )
+
+
+async def send_menu(bot: Bot, chat_id: int, query: Query):
+    profile = await user_db.profile_of(chat_id)
+    query.allergens = profile.allergens
+    mensa_code = profile.mensa
     logging.debug(f"allergens: {query.allergens}, mensa_code: {mensa_code}")
     if mensa_code is None:
         raise TypeError("No mensa selected")
-    json_object = client.get_json(config.endpoint, mensa_code, query)
-    reply = "".join(client.render_group(group) for group in json_object)
-    if reply:
-        bot.send_message(chat_id, emojize(reply), parse_mode=ParseMode.MARKDOWN)
-    else:
-        bot.send_message(chat_id, emojize(f"Kein Essen gefunden. {error_emoji()}"))
+    if query.until:
+        menus = await client.get_json_range_async(config.endpoint, mensa_code, query)
+        reply_menus(bot, chat_id, menus)
+        return
+    try:
+        reply = render_groups(
+            await client.get_json_async(config.endpoint, mensa_code, query)
+        )
+    except (ValueError, JSONDecodeError) as e:
+        logging.debug(e)
+        sender.send_message(bot, chat_id, unsupported_message())
+        return
+    except UpstreamError as e:
+        logging.warning(f"Menu for {chat_id} unavailable: {e}")
+        sender.send_message(bot, chat_id, unavailable_message())
+        return
+    sender.send_message(bot, chat_id, reply, parse_mode=ParseMode.MARKDOWN)
+
+
+def reply_menus(
+    bot: Bot, chat_id: int, menus: List[Tuple[date, Union[list, Exception]]]
+):
+    if all(isinstance(menu, UpstreamError) for _, menu in menus):
+        sender.send_message(bot, chat_id, unavailable_message())
+        return
+    blocks = [render_day(day, menu) for day, menu in menus]
+    stale = [menu for _, menu in menus if isinstance(menu, client.StaleMenu)]
+    if stale:
+        oldest = min(stale, key=lambda menu: menu.fetched_at)
+        blocks.insert(0, stale_notice(oldest).strip())
+    for message in pack_messages(blocks):
+        sender.send_message(
+            bot, chat_id, emojize(message), parse_mode=ParseMode.MARKDOWN
+        )
+
+
+def render_day(day: date, menu: Union[list, Exception]) -> str:
+    header = f"*{WEEKDAY_NAMES[day.weekday()].upper()}, {day.strftime('%d.%m.')}*"
+    if isinstance(menu, ValueError):
+        return f"{header}\nKein Essen. {error_emoji()}"
+    if isinstance(menu, UpstreamError):
+        logging.debug(f"Menu for {day} unavailable: {menu}")
+        return f"{header}\nNicht erreichbar. {error_emoji()}"
+    if isinstance(menu, Exception):
+        raise menu
+    meals = [client.render_meal(meal) for group in menu for meal in group["items"]]
+    if not meals:
+        return f"{header}\nKein Essen gefunden. {error_emoji()}"
+    return "\n".join([header] + meals)
+
+
+def pack_messages(blocks: List[str]) -> List[str]:
+    messages: List[str] = []
+    current = ""
+    for block in blocks:
+        for part in split_block(block):
+            if current and len(current) + 2 + len(part) > MAX_MESSAGE_LENGTH:
+                messages.append(current)
+                current = ""
+            current = f"{current}\n\n{part}" if current else part
+    if current:
+        messages.append(current)
+    return messages
+
+
+def split_block(block: str) -> List[str]:
+    parts: List[str] = []
+    current = ""
+    for line in block.split("\n"):
+        line = line[:MAX_MESSAGE_LENGTH]
+        if current and len(current) + 1 + len(line) > MAX_MESSAGE_LENGTH:
+            parts.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    parts.append(current)
+    return parts
 
 
 @debug_logging
-def menu_handler(update: Update, context: CallbackContext):
+async def inline_handler(update: Update, context: CallbackContext):
+    inline_query = update.inline_query
+    user_id = inline_query.from_user.id
+    previous = pending_inline.get(user_id)
+    if previous:
+        previous.cancel()
+    pending_inline[user_id] = asyncio.ensure_future(
+        debounced_inline_query(context.bot, inline_query)
+    )
+
+
+async def debounced_inline_query(bot: Bot, inline_query: InlineQuery):
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    del pending_inline[inline_query.from_user.id]
+    try:
+        with metrics.handler_duration.labels("reply_inline_query").time():
+            await reply_inline_query(bot, inline_query)
+    except Exception:
+        logging.exception(f"Answering inline query {inline_query.id} failed")
+
+
+async def reply_inline_query(bot: Bot, inline_query: InlineQuery):
+    profile = await user_db.profile_of(inline_query.from_user.id)
+    if profile.mensa is None:
+        await runtime.in_thread(
+            bot.answer_inline_query,
+            inline_query.id,
+            [],
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=True,
+            switch_pm_text="Mensa auswählen",
+            switch_pm_parameter="mensa",
+        )
+        return
+    try:
+        query = Query.from_text(demojize(inline_query.query))
+        query.allergens = profile.allergens
+        results = await inline_results(profile.mensa, query)
+    except (ValueError, JSONDecodeError, UpstreamError) as e:
+        logging.debug(e)
+        results = []
+    await runtime.in_thread(
+        bot.answer_inline_query,
+        inline_query.id,
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+    )
+
+
+async def inline_results(
+    mensa_code: int, query: Query
+) -> List[InlineQueryResultArticle]:
+    key = (mensa_code, query.key())
+    results = inline_cache.get(key)
+    if results is None:
+        if query.until:
+            results = inline_day_results(
+                await client.get_json_range_async(config.endpoint, mensa_code, query)
+            )
+        else:
+            results = inline_menu_results(
+                await client.get_json_async(config.endpoint, mensa_code, query)
+            )
+        inline_cache[key] = results
+    return results
+
+
+def inline_menu_results(menu: list) -> List[InlineQueryResultArticle]:
+    groups = [group for group in menu if group["items"]]
+    notice = stale_notice(menu)
+    articles = [
+        InlineQueryResultArticle(
+            id=str(n),
+            title=group["name"],
+            description=", ".join(meal["name"] for meal in group["items"])[:100],
+            input_message_content=InputTextMessageContent(
+                emojize(notice + client.render_group(group)),
+                parse_mode=ParseMode.MARKDOWN,
+            ),
+        )
+        for n, group in enumerate(groups, start=1)
+    ]
+    everything = render_groups(menu)
+    if len(articles) > 1 and len(everything) <= MAX_MESSAGE_LENGTH:
+        articles.insert(
+            0,
+            InlineQueryResultArticle(
+                id="0",
+                title="Alles",
+                description=", ".join(group["name"] for group in groups)[:100],
+                input_message_content=InputTextMessageContent(
+                    everything, parse_mode=ParseMode.MARKDOWN
+                ),
+            ),
+        )
+    return articles
+
+
+def inline_day_results(
+    menus: List[Tuple[date, Union[list, Exception]]]
+) -> List[InlineQueryResultArticle]:
+    articles = []
+    for day, menu in menus:
+        if isinstance(menu, (ValueError, UpstreamError)):
+            logging.debug(f"Menu for {day} unavailable: {menu}")
+            continue
+        if isinstance(menu, Exception):
+            raise menu
+        groups = [group for group in menu if group["items"]]
+        if not groups:
+            continue
+        articles.append(
+            InlineQueryResultArticle(
+                id=day.isoformat(),
+                title=f"{WEEKDAY_NAMES[day.weekday()]}, {day.strftime('%d.%m.')}",
+                description=", ".join(group["name"] for group in groups)[:100],
+                input_message_content=InputTextMessageContent(
+                    emojize(
+                        pack_messages([stale_notice(menu) + render_day(day, menu)])[0]
+                    ),
+                    parse_mode=ParseMode.MARKDOWN,
+                ),
+            )
+        )
+    return articles
+
+
+@debug_logging
+async def menu_handler(update: Update, context: CallbackContext):
     logging.info(f"{update.effective_message.chat_id} asks for a menu")
-    text = demojize("".join(context.args))
+    text = demojize(" ".join(context.args))
     try:
-        send_menu(context.bot, update.effective_message.chat_id, Query.from_text(text))
-    except TypeError as e:
+        query = Query.from_text(text)
+    except ValueError as e:
         logging.debug(e)
-        context.bot.send_message(
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             emojize(
-                f"Wie es aussieht, hast Du noch keine Mensa ausgewählt. {error_emoji()}\n"
-                f"Tu dies zum Beispiel mit „/mensa HU“ :information:"
+                f"Dieses Datum verstehe ich nicht. {error_emoji()}\n"
+                f"Versuche es zum Beispiel mit „/menu 2018-10-22“."
             ),
         )
-    except (ValueError, JSONDecodeError) as e:
+        return
+    try:
+        await send_menu(context.bot, update.effective_message.chat_id, query)
+    except TypeError as e:
         logging.debug(e)
-        context.bot.send_message(
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             emojize(
-                f"Entweder ist diese Mensa noch nicht unterstützt, {error_emoji()}\n"
-                f"oder es gibt an diesem Tag dort kein Essen. {error_emoji()}"
+                f"Wie es aussieht, hast Du noch keine Mensa ausgewählt. {error_emoji()}\n"
+                f"Tu dies zum Beispiel mit „/mensa HU“ :information:"
             ),
         )
 
 
 @debug_logging
-def info_handler(update: Update, context: CallbackContext):
-    number_name = client.get_allergens(config.endpoint)
-    code_name = client.get_mensas(config.endpoint)
-    myallergens = user_db.allergens_of(update.effective_message.chat_id)
-    mymensa = user_db.mensa_of(update.effective_message.chat_id)
-    subscribed = user_db.is_subscriber(update.effective_message.chat_id)
-    subscription_time = jobs.show_job_time(update.effective_message.chat_id)
-    subscription_filter = (
-        user_db.menu_filter_of(update.effective_message.chat_id) or "kein Filter"
-    )
-    context.bot.send_message(
-        update.effective_message.chat_id,
+async def info_handler(update: Update, context: CallbackContext):
+    chat_id = update.effective_message.chat_id
+    try:
+        profile, number_name, code_name = await asyncio.gather(
+            user_db.profile_of(chat_id),
+            client.get_allergens_async(config.endpoint),
+            client.get_mensas_async(config.endpoint),
+        )
+    except (JSONDecodeError, UpstreamError) as e:
+        logging.warning(f"Info for {chat_id} unavailable: {e}")
+        sender.send_message(context.bot, chat_id, unavailable_message())
+        return
+    myallergens = profile.allergens
+    mymensa = profile.mensa
+    subscribed = profile.subscribed
+    subscription_time = jobs.show_job_time(profile)
+    subscription_filter = profile.menu_filter or "kein Filter"
+    sender.send_message(
+        context.bot,
+        chat_id,
         "*MENSA*\n{mensa}\n\n*ABO*\n{subscription}\n\n*ALLERGENE*\n{allergens}".format(
             mensa=code_name[mymensa] if mymensa is not None else "keine",
             allergens="\n".join(number_name[number] for number in myallergens),
@@ -154,15 +421,23 @@ def info_handler(update: Update, context: CallbackContext):
 
 
 @debug_logging
-def allergens_handler(update: Update, context: CallbackContext):
-    number_name = client.get_allergens(config.endpoint)
+async def allergens_handler(update: Update, context: CallbackContext):
+    try:
+        number_name = await client.get_allergens_async(config.endpoint)
+    except (JSONDecodeError, UpstreamError) as e:
+        logging.warning(f"Allergen list unavailable: {e}")
+        sender.send_message(
+            context.bot, update.effective_message.chat_id, unavailable_message()
+        )
+        return
     allergens_chooser = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text=name, callback_data=f"A{number}")]
             for number, name in number_name.items()
         ]
     )
-    context.bot.send_message(
+    sender.send_message(
+        context.bot,
         update.effective_message.chat_id,
         emojize("Wähle Deine Allergene aus. :index_pointing_up:"),
         reply_markup=allergens_chooser,
@@ -170,98 +445,136 @@ def allergens_handler(update: Update, context: CallbackContext):
 
 
 @debug_logging
-def resetallergens_handler(update: Update, context: CallbackContext):
+async def resetallergens_handler(update: Update, context: CallbackContext):
     logging.info(f"Allergens reset for {update.effective_message.chat_id}")
-    user_db.reset_allergens_for(update.effective_message.chat_id)
-    context.bot.send_message(
+    await user_db.reset_allergens_for(update.effective_message.chat_id)
+    sender.send_message(
+        context.bot,
         update.effective_message.chat_id,
         "Allergene zurückgesetzt.",
     )
 
 
 @debug_logging
-def mensa_handler(update: Update, context: CallbackContext):
+async def mensa_handler(update: Update, context: CallbackContext):
     text = " ".join(context.args)
     pattern = text.strip()
-    code_name = None
-    for retries in range(config.retries_api_failure):
-        try:
-            code_name = client.get_mensas(config.endpoint, pattern)
-            break
-        except JSONDecodeError:
-            logging.debug(
-                f"JSONDecodeError: Try number {retries + 1} / {config.retries_api_failure}"
-            )
-            sleep(1)
-            continue
-    if code_name is None:
-        logging.exception("Failed to load code_names")
+    try:
+        code_name = await client.get_mensas_async(config.endpoint, pattern)
+    except (JSONDecodeError, UpstreamError) as e:
+        logging.warning(f"Mensa list unavailable: {e}")
+        sender.send_message(
+            context.bot, update.effective_message.chat_id, unavailable_message()
+        )
         return
-    mensa_chooser = InlineKeyboardMarkup(
+    sender.send_message(
+        context.bot,
+        update.effective_message.chat_id,
+        emojize("Wähle Deine Mensa aus. :index_pointing_up:"),
+        reply_markup=mensa_chooser(
+            tuple(sorted(code_name.items(), key=lambda item: item[1]))
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def mensa_chooser(mensas: Tuple[Tuple[int, str], ...]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text=name, callback_data=code)]
-            for code, name in sorted(code_name.items(), key=lambda item: item[1])
+            for code, name in mensas
         ]
     )
-    context.bot.send_message(
-        update.effective_message.chat_id,
-        emojize("Wähle Deine Mensa aus. :index_pointing_up:"),
-        reply_markup=mensa_chooser,
-    )
 
 
 @debug_logging
-def callback_handler(update: Update, context: CallbackContext):
+async def callback_handler(update: Update, context: CallbackContext):
     query = update.callback_query
     if query:
         if query.data.startswith("A"):
-            allergen_number = query.data.lstrip("A")
-            name = client.get_allergens(config.endpoint)[allergen_number]
-            context.bot.answer_callback_query(query.id, text=f"„{name}” usgewählt.")
-            allergens = user_db.allergens_of(query.message.chat_id)
-            allergens.add(allergen_number)
-            user_db.set_allergens_for(query.message.chat_id, allergens)
-            logging.info(f"Set {query.message.chat_id} allergens to {allergens}")
+            await choose_allergen(context.bot, query)
         else:
-            name = client.get_mensas(config.endpoint)[int(query.data)]
-            context.bot.answer_callback_query(
-                query.id,
-                text=f"„{name}“ ausgewählt.",
-            )
-            user_db.set_mensa_for(query.message.chat_id, query.data)
-            logging.info(f"Set {query.message.chat_id} mensa to {query.data}")
+            await choose_mensa(context.bot, query)
+
+
+async def choose_allergen(bot: Bot, query: CallbackQuery):
+    allergen_number = query.data.lstrip("A")
+    try:
+        name = (await client.get_allergens_async(config.endpoint))[allergen_number]
+    except (JSONDecodeError, UpstreamError) as e:
+        logging.warning(f"Allergen list unavailable: {e}")
+        await runtime.in_thread(
+            bot.answer_callback_query, query.id, text=UNAVAILABLE_CALLBACK_TEXT
+        )
+        return
+    added = await user_db.toggle_allergen(query.message.chat_id, allergen_number)
+    await runtime.in_thread(
+        bot.answer_callback_query,
+        query.id,
+        text=f"„{name}” {'ausgewählt' if added else 'abgewählt'}.",
+    )
+    logging.info(
+        f"{'Added' if added else 'Removed'} allergen {allergen_number} "
+        f"for {query.message.chat_id}"
+    )
+
+
+async def choose_mensa(bot: Bot, query: CallbackQuery):
+    try:
+        name = (await client.get_mensas_async(config.endpoint))[int(query.data)]
+    except (JSONDecodeError, UpstreamError) as e:
+        logging.warning(f"Mensa list unavailable: {e}")
+        await runtime.in_thread(
+            bot.answer_callback_query, query.id, text=UNAVAILABLE_CALLBACK_TEXT
+        )
+        return
+    await runtime.in_thread(
+        bot.answer_callback_query,
+        query.id,
+        text=f"„{name}“ ausgewählt.",
+    )
+    await user_db.set_mensa_for(query.message.chat_id, query.data)
+    logging.info(f"Set {query.message.chat_id} mensa to {query.data}")
 
 
 @debug_logging
-def subscribe_handler(update: Update, context: CallbackContext):
-    filter_text = demojize("".join(context.args))
-    is_refreshed = user_db.menu_filter_of(update.effective_message.chat_id) not in [
-        filter_text,
-        None,
-    ]
-    if not is_refreshed and user_db.is_subscriber(update.effective_message.chat_id):
-        context.bot.send_message(
-            update.effective_message.chat_id, "Du hast den Speiseplan schon abonniert."
+async def subscribe_handler(update: Update, context: CallbackContext):
+    filter_text = demojize(" ".join(context.args)).strip()
+    profile = await user_db.profile_of(update.effective_message.chat_id)
+    is_refreshed = profile.menu_filter not in [filter_text, None]
+    if not is_refreshed and profile.subscribed:
+        sender.send_message(
+            context.bot,
+            update.effective_message.chat_id,
+            "Du hast den Speiseplan schon abonniert.",
         )
     else:
+        subscription_time = profile.subscription_time
         time_match = re.search(TIME_PATTERN, filter_text)
         if time_match:
-            first_time = time_match.group(0)
-            user_db.set_subscription_time(
+            subscription_time = datetime.strptime(time_match.group(0), "%H:%M").time()
+            filter_text = filter_text.replace(time_match.group(0), "").strip()
+        if not is_daily_filter(filter_text):
+            sender.send_message(
+                context.bot,
                 update.effective_message.chat_id,
-                datetime.strptime(first_time, "%H:%M").time(),
+                emojize(
+                    f"Ein Abo gilt für jeden Tag, lass das Datum bitte weg. "
+                    f"{error_emoji()}\n"
+                    f"Zum Beispiel: „/subscribe 11:30 :seedling: 3€“"
+                ),
             )
-            filter_text = filter_text.replace(first_time, "")
-        user_db.set_subscription(update.effective_message.chat_id, True)
-        user_db.set_menu_filter(update.effective_message.chat_id, filter_text)
-        jobs.remove_subscriber(str(update.effective_message.chat_id))
-        jobs.add_subscriber(str(update.effective_message.chat_id))
+            return
+        await user_db.subscribe(
+            update.effective_message.chat_id, subscription_time, filter_text
+        )
         logging.info(
             f"Subscribed {update.effective_message.chat_id} for notification with filter '{filter_text}'"
         )
         if is_refreshed:
             logging.debug(f"Subscription updated {update.effective_message.chat_id}")
-        context.bot.send_message(
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             "Du bekommst ab jetzt täglich den Speiseplan zugeschickt."
             if not is_refreshed
@@ -269,51 +582,71 @@ def subscribe_handler(update: Update, context: CallbackContext):
         )
 
 
+def is_daily_filter(filter_text: str) -> bool:
+    try:
+        query = Query.from_text(filter_text)
+    except ValueError:
+        return False
+    return query.date is None and query.until is None
+
+
 @debug_logging
-def unsubscribe_handler(update: Update, context: CallbackContext):
+async def unsubscribe_handler(update: Update, context: CallbackContext):
+    profile = await user_db.profile_of(update.effective_message.chat_id)
     logging.debug(
-        f"{update.effective_message.chat_id} "
-        f"is_subscriber: {user_db.is_subscriber(update.effective_message.chat_id)}"
+        f"{update.effective_message.chat_id} is_subscriber: {profile.subscribed}"
     )
-    if user_db.is_subscriber(update.effective_message.chat_id):
-        user_db.set_subscription(update.effective_message.chat_id, False)
-        jobs.remove_subscriber(str(update.effective_message.chat_id))
+    if profile.subscribed:
+        await user_db.unsubscribe(update.effective_message.chat_id)
         logging.info(f"Unsubscribed {update.effective_message.chat_id}")
-        context.bot.send_message(
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             "Du hast den Speiseplan erfolgreich abbestellt.",
         )
     else:
-        context.bot.send_message(
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             "Du hast den Speiseplan gar nicht abonniert.",
         )
 
 
 @debug_logging
-def chat_id_handler(update: Update, context: CallbackContext):
-    context.bot.send_message(
+async def chat_id_handler(update: Update, context: CallbackContext):
+    sender.send_message(
+        context.bot,
         update.effective_message.chat_id,
         f"{update.effective_message.chat_id}",
     )
 
 
 @debug_logging
-def status_handler(update: Update, context: CallbackContext):
+async def status_handler(update: Update, context: CallbackContext):
     if str(update.effective_message.chat_id) in config.moderators:
-        context.bot.send_message(
+        users, subscribers, scheduled = await asyncio.gather(
+            user_db.user_count(), user_db.subscriber_count(), user_db.scheduled_count()
+        )
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             f"*USER*\n"
-            f"Registriert: {len(user_db.users())}\n"
-            f"Abonniert: {len(list(user for user in user_db.users() if user_db.is_subscriber(user)))}\n\n"
+            f"Registriert: {users}\n"
+            f"Abonniert: {subscribers}\n\n"
             f"*CONFIG*\n"
+            f"Modus: {config.mode}\n"
             f"Worker: {config.workers}\n"
             f"Moderatoren: {', '.join(config.moderators)}\n"
             f"Abozeit: {config.notification_time.strftime('%H:%M')}\n"
             f"API-Anfragen-Wiederholung: {config.retries_api_failure}\n"
+            f"HTTP-Pool: {config.http_pool_size}\n"
+            f"Timeouts: {config.connect_timeout}s / {config.read_timeout}s\n"
+            f"Ausgehende Warteschlange: {sender.outbox.pending()}\n"
+            f"API-Circuits:\n{client.breaker_status() or 'keine Anfragen'}\n"
             f"Debug: {'ja' if config.debug else 'nein'}\n"
             f"Loglevel: {logging.getLogger().getEffectiveLevel()}\n\n"
-            f"*ABONNEMENTS*\n{jobs.show_job_queue()}",
+            f"*ABONNEMENTS*\n{jobs.show_job_queue(scheduled)}\n\n"
+            f"*METRIKEN*\n{metrics.summary()}",
             parse_mode="Markdown",
         )
     else:
@@ -321,13 +654,14 @@ def status_handler(update: Update, context: CallbackContext):
 
 
 @debug_logging
-def broadcast_handler(update: Update, context: CallbackContext):
+async def broadcast_handler(update: Update, context: CallbackContext):
     logging.debug(f"MODERATORS: {config.moderators}")
     if str(update.effective_message.chat_id) not in config.moderators:
         logging.warning(
             f"{update.effective_message.chat_id} tried to send a broadcast message, but is no moderator"
         )
-        context.bot.send_message(
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             emojize(
                 f"Du hast nicht die Berechtigung einen Broadcast zu versenden. {error_emoji()}"
@@ -336,49 +670,41 @@ def broadcast_handler(update: Update, context: CallbackContext):
         return None
     text = demojize(" ".join(context.args))
     if not text:
-        context.bot.send_message(
+        sender.send_message(
+            context.bot,
             update.effective_message.chat_id,
             emojize(f"Broadcast-Text darf nicht leer sein. {error_emoji()}"),
         )
         return None
     emojized_text = emojize(text)
     logging.info(f"Sending the following broadcast: {emojized_text}")
-    for user_id in user_db.users():
-        if user_id == update.effective_message.chat_id:
-            logging.debug(f"Skipped {user_id}")
-            continue
-        logging.debug(f"Send to {user_id}, text: {text}")
-        try:
-            context.bot.send_message(user_id, emojized_text)
-            logging.info(f"Broadcast successfully sent to {user_id}")
-        except Unauthorized:
-            logging.exception(
-                f"Skipped and removed {user_id}, because he blocked the bot"
-            )
-            user_db.remove_user(user_id)
-            jobs.remove_subscriber(user_id)
-            continue
-    context.bot.send_message(
+    await runtime.in_thread(
+        broadcast.start_broadcast,
+        context.job_queue,
+        context.bot,
         update.effective_message.chat_id,
-        emojize("Broadcast erfolgreich versendet. :thumbs_up:"),
+        emojized_text,
     )
 
 
 @debug_logging
-def debug_handler(update: Update, context: CallbackContext):
+async def debug_handler(update: Update, context: CallbackContext):
     if str(update.effective_message.chat_id) in config.moderators:
         if config.debug:
             config.debug = False
             config.set_logging_level()
-            context.bot.send_message(
+            sender.send_message(
+                context.bot,
                 update.effective_message.chat_id,
                 emojize("Debug deaktiviert. :zipper-mouth_face:"),
             )
         else:
             config.debug = True
             config.set_logging_level()
-            context.bot.send_message(
-                update.effective_message.chat_id, emojize("Debug aktiviert. :wrench:")
+            sender.send_message(
+                context.bot,
+                update.effective_message.chat_id,
+                emojize("Debug aktiviert. :wrench:"),
             )
         logging.info(f"Log level is now {logging.getLogger().getEffectiveLevel()}")
     else:
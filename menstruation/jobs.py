@@ -1,113 +1,310 @@
 import logging
+from concurrent.futures import Future
+from datetime import datetime, time, timedelta
+from functools import partial
 from json import JSONDecodeError
-from random import randint
-from time import sleep
-from typing import Union
+from random import uniform
+from typing import Union, Dict, List, Hashable, Optional, Iterable, Tuple
 
 from emoji import emojize
+from telegram import Bot, ParseMode
 from telegram.error import Unauthorized, NetworkError
 from telegram.ext import CallbackContext, JobQueue
 
-from menstruation import config
-from menstruation.handlers import send_menu, error_emoji
+import menstruation.client as client
+from menstruation import broadcast, config, metrics, migrate, runtime, sender
+from menstruation.client import UpstreamError
+from menstruation.config import UserProfile
+from menstruation.handlers import render_groups, error_emoji
 from menstruation.query import Query
+from menstruation.shards import PartitionLeases
 
 user_db = config.user_db
 job_queue = None
+leases: Optional[PartitionLeases] = None
+last_dispatch: Optional[datetime] = None
+
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 15 * 60
+MAX_CATCH_UP = timedelta(minutes=15)
 
 
 def startup_message(context: CallbackContext):
     for moderator in config.moderators:
         try:
-            context.bot.send_message(
-                moderator, emojize("Server wurde gestartet. :robot:")
-            )
+            sender.send_message(
+                context.bot, moderator, emojize("Server wurde gestartet. :robot:")
+            ).result()
         except Unauthorized:
             logging.exception(f"Moderator: {moderator}, has blocked the Bot.")
         except Exception as err:
             logging.exception(f"Error in startup_message: {err}")
 
 
-def add_subscriber(user_id: Union[str, int]):
-    if job_queue:
-        user_id = int(user_id)
-        user_time = user_db.subscription_time_of(user_id)
-        notification_time = user_time or config.notification_time
-        logging.debug(f"Added subscriber: {user_id}, time: {notification_time}")
-        job_queue.run_daily(
-            notify_subscriber,
-            notification_time,
-            days=tuple(range(5)),
-            name=str(user_id),
-        )
-    else:
-        logging.error("Cannot add subscriber: job queue uninitialized")
+def remove_subscriber(user_id: Union[str, int]):
+    logging.debug(f"Removed subscriber: {user_id}")
+    user_db.unschedule(int(user_id))
 
 
-def remove_subscriber(user_id: Union[str, int]):
-    if job_queue:
-        logging.debug(f"Removed subscriber: {user_id}")
-        for job in job_queue.get_jobs_by_name(str(user_id)):
-            job.schedule_removal()
-    else:
-        logging.error("Cannot remove subscriber: job queue uninitialized")
+def dispatch_start(last: Optional[datetime], now: datetime) -> Optional[time]:
+    if last is None:
+        return now.time()
+    elif last >= now:
+        return None
+    start = max(last + timedelta(minutes=1), now - MAX_CATCH_UP)
+    return start.time() if start.date() == now.date() else time(0, 0)
 
 
-def notify_subscriber(context: CallbackContext):
-    user_id = context.job.name
-    if not user_db.is_subscriber(user_id):
-        logging.error(f"{user_id} is no subscriber, but had a subscription job")
-        remove_subscriber(user_id)
+def dispatch(context: CallbackContext):
+    global last_dispatch
+    now = datetime.now(context.job_queue.scheduler.timezone).replace(
+        second=0, microsecond=0
+    )
+    if leases:
+        owned = leases.owned_partitions()
+        starts = {
+            partition: dispatch_start(cursor, now)
+            for partition, cursor in leases.cursors(owned).items()
+        }
+        leases.set_cursors(owned, now)
+    else:
+        starts = {None: dispatch_start(last_dispatch, now)}
+        last_dispatch = now
+    if now.weekday() >= 5:
         return
-    logging.debug(f"Notify: {user_id}")
-    filter_text = user_db.menu_filter_of(user_id) or ""
-    users_sum = len(user_db.users())
-    for retries in range(config.retries_api_failure):
-        try:
-            send_menu(context.bot, user_id, Query.from_text(filter_text))
-            logging.info("Successfully notified %s" % user_id)
-            break
-        except TypeError:
-            logging.exception(f"{user_id} has no mensa selected")
-        except (JSONDecodeError, NetworkError):
+    for start in set(starts.values()):
+        if start is None:
+            continue
+        user_ids = user_db.scheduled_between(start, now.time())
+        if leases:
+            user_ids = [
+                user_id
+                for user_id in user_ids
+                if starts.get(leases.partition_of(user_id)) == start
+            ]
+        if user_ids:
             logging.debug(
-                f"JSONDecodeError: Try number {retries + 1} / {config.retries_api_failure}"
+                f"Dispatching {start}–{now.time()}: {len(user_ids)} subscribers"
             )
-            # Wait a random time and try again
-            max_time = 200 + (200 * users_sum)
-            sleep(randint(100, max_time) / 100)
+            notify_subscribers(context.bot, user_ids)
+
+
+def cohort_key(mensa_code: int, query: Query) -> Hashable:
+    return mensa_code, query.key()
+
+
+def group_cohorts(
+    profiles: Iterable[UserProfile],
+) -> Dict[Hashable, Tuple[int, Query, List[int]]]:
+    cohorts: Dict[Hashable, Tuple[int, Query, List[int]]] = dict()
+    for profile in profiles:
+        if profile.mensa is None:
             continue
-        except Unauthorized:
-            logging.exception(f"{user_id} has blocked the bot. Removed Subscription")
-            user_db.set_subscription(user_id, False)
-            remove_subscriber(user_id)
+        query = Query.from_text(profile.menu_filter or "")
+        # filters saved before /subscribe rejected dates must not pin a day
+        query.date = query.until = None
+        query.allergens = profile.allergens
+        key = cohort_key(profile.mensa, query)
+        if key not in cohorts:
+            cohorts[key] = profile.mensa, query, []
+        cohorts[key][2].append(profile.user_id)
+    return cohorts
+
+
+def notify_subscribers(
+    bot: Bot, user_ids: List[int], attempts: Optional[Dict[int, int]] = None
+):
+    attempts = attempts or dict()
+    profiles = []
+    for profile in user_db.profiles(user_ids):
+        if not profile.subscribed:
+            logging.error(
+                f"{profile.user_id} is no subscriber, but had a subscription job"
+            )
+            remove_subscriber(profile.user_id)
+        elif profile.mensa is None:
+            logging.error(f"{profile.user_id} has no mensa selected")
+        else:
+            profiles.append(profile)
+    cohorts = list(group_cohorts(profiles).values())
+    logging.info(f"Notify {len(user_ids)} subscribers in {len(cohorts)} cohorts")
+    menus = runtime.loop.call(
+        runtime.gather(
+            client.get_json_async(config.endpoint, mensa_code, query)
+            for mensa_code, query, _ in cohorts
+        )
+    )
+    failed: List[int] = []
+    deliveries: Dict[int, Future] = dict()
+    for (mensa_code, _, members), menu in zip(cohorts, menus):
+        try:
+            if isinstance(menu, Exception):
+                raise menu
+            deliveries.update(notify_cohort(bot, render_groups(menu), members))
+        except (JSONDecodeError, UpstreamError) as err:
+            logging.debug(f"Menu for mensa {mensa_code} unavailable: {err}")
+            failed.extend(members)
         except Exception as err:
-            logging.exception(f"Exception: {err}")
-        logging.exception(f"Menu for {user_id} could not be delivered")
-        break
+            logging.exception(f"Menu for {members} could not be delivered: {err}")
+    for profile in profiles:
+        if profile.user_id in deliveries:
+            deliveries[profile.user_id].add_done_callback(
+                partial(record_lag, profile.notification_time)
+            )
+    for user_id, delivery in deliveries.items():
+        delivery.add_done_callback(partial(check_delivery, user_id, failed))
+    client.all_done(list(deliveries.values())).add_done_callback(
+        lambda _: retry_failed(failed, attempts)
+    )
+
+
+def notify_cohort(bot: Bot, reply: str, user_ids: List[int]) -> Dict[int, Future]:
+    return {
+        user_id: sender.send_message(
+            bot, user_id, reply, priority=sender.BULK, parse_mode=ParseMode.MARKDOWN
+        )
+        for user_id in user_ids
+    }
+
+
+def record_lag(notification_time: time, delivery: Future):
+    if delivery.exception() is not None:
+        return
+    now = datetime.now(job_queue.scheduler.timezone if job_queue else None)
+    due = now.replace(
+        hour=notification_time.hour,
+        minute=notification_time.minute,
+        second=0,
+        microsecond=0,
+    )
+    metrics.notification_lag.labels().observe(max(0.0, (now - due).total_seconds()))
+
+
+def check_delivery(user_id: int, failed: List[int], delivery: Future):
+    try:
+        delivery.result()
+        logging.info("Successfully notified %s" % user_id)
+    except Unauthorized:
+        logging.exception(f"{user_id} has blocked the bot. Removed Subscription")
+        user_db.set_subscription(user_id, False)
+        remove_subscriber(user_id)
+    except NetworkError as err:
+        logging.debug(f"Menu for {user_id} could not be sent: {err}")
+        failed.append(user_id)
+    except Exception as err:
+        logging.exception(f"Menu for {user_id} could not be delivered: {err}")
+
+
+def retry_failed(failed: List[int], attempts: Dict[int, int]):
+    if failed:
+        schedule_retry({user_id: attempts.get(user_id, 0) + 1 for user_id in failed})
+
+
+def retry_delay(attempt: int) -> float:
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + uniform(0, delay / 2)
+
+
+def schedule_retry(attempts: Dict[int, int]):
+    for user_id, attempt in list(attempts.items()):
+        if attempt >= config.retries_api_failure:
+            logging.error(
+                f"Menu for {user_id} could not be delivered after {attempt} attempts"
+            )
+            del attempts[user_id]
+    if not attempts:
+        return
+    if not job_queue:
+        logging.error("Cannot retry notifications: job queue uninitialized")
+        return
+    attempt = max(attempts.values())
+    delay = retry_delay(attempt)
+    logging.debug(
+        f"Retrying {len(attempts)} notifications in {delay:.0f}s "
+        f"(try {attempt + 1} / {config.retries_api_failure})"
+    )
+    job_queue.run_once(retry_subscribers, delay, context=attempts, name="retry")
+
+
+def retry_subscribers(context: CallbackContext):
+    attempts: Dict[int, int] = context.job.context
+    notify_subscribers(context.bot, list(attempts), attempts)
+
+
+def prewarm(context: CallbackContext):
+    slot = datetime.now(context.job_queue.scheduler.timezone).replace(
+        second=0, microsecond=0
+    ) + timedelta(minutes=config.prewarm_minutes)
+    if slot.weekday() >= 5:
+        return
+    user_ids = user_db.scheduled_between(slot.time(), slot.time())
+    if leases:
+        user_ids = [user_id for user_id in user_ids if leases.owns(user_id)]
+    if user_ids:
+        warm_cache(user_db.profiles(user_ids))
+
+
+def warm_cache(profiles: Iterable[UserProfile]):
+    cohorts = group_cohorts(profile for profile in profiles if profile.subscribed)
+    logging.debug(f"Prewarming cache for {len(cohorts)} cohorts")
+    results = runtime.loop.call(
+        runtime.gather(
+            [
+                client.get_allergens_async(config.endpoint),
+                client.get_mensas_async(config.endpoint),
+            ]
+            + [
+                client.get_json_async(config.endpoint, mensa_code, query)
+                for mensa_code, query, _ in cohorts.values()
+            ]
+        )
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning(f"Prewarming failed: {result}")
 
 
 def setup_job_queue(jq: JobQueue):
-    global job_queue
+    global job_queue, leases
     job_queue = jq
     job_queue.run_once(startup_message, 0)
 
-    for user_id in user_db.users():
-        if user_db.is_subscriber(user_id):
-            add_subscriber(str(user_id))
+    with user_db.redis.lock("index_lock", timeout=600):
+        migrate.migrate(user_db)
+        if not user_db.has_index():
+            logging.info("Building user index and subscription schedule")
+            user_db.rebuild_index()
+    if config.partitions > 0:
+        leases = PartitionLeases(user_db.redis, config.partitions, config.lease_ttl)
+        leases.start()
+    next_minute = datetime.now(job_queue.scheduler.timezone).replace(
+        second=0, microsecond=0
+    ) + timedelta(minutes=1)
+    job_queue.run_repeating(dispatch, 60, first=next_minute, name="dispatch")
+    broadcast.resume_broadcasts(job_queue)
+    if config.prewarm_minutes > 0:
+        job_queue.run_repeating(prewarm, 60, first=next_minute, name="prewarm")
     job_queue.start()
 
 
-def show_job_time(user_id: Union[str, int]):
-    user_id = int(user_id)
-    user_time = user_db.subscription_time_of(user_id)
-    job_time = user_time if user_time else config.notification_time
-    return job_time.strftime("%H:%M")
+def release_partitions():
+    if leases:
+        leases.release()
 
 
-def show_job_queue() -> str:
+def show_job_time(profile: UserProfile):
+    return profile.notification_time.strftime("%H:%M")
+
+
+def show_job_queue(scheduled: int) -> str:
     if job_queue:
         text = "\n".join(f"*{job.name}* {job.next_t}" for job in job_queue.jobs())
-        return emojize(text)
+        if leases:
+            text += (
+                f"\nPartitionen ({leases.instance}): "
+                f"{', '.join(map(str, sorted(leases.owned_partitions())))} "
+                f"/ {leases.partitions}"
+            )
+        return emojize(f"{text}\nAbonnenten: {scheduled}")
     else:
         return emojize(f"Job queue uninitialized! {error_emoji()}")
@@ -0,0 +1,294 @@
+import asyncio
+import bisect
+import functools
+import logging
+import math
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def render_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def render_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = dict()
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def series(self) -> List[Tuple[Tuple[str, ...], object]]:
+        with self.lock:
+            return sorted(self.children.items())
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in self.series():
+            lines.extend(self.render_child(values, child))
+        return lines
+
+    def render_child(self, values: Tuple[str, ...], child) -> List[str]:
+        raise NotImplementedError
+
+
+class CounterValue(object):
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self) -> CounterValue:
+        return CounterValue()
+
+    def total(self, *values) -> float:
+        child = self.children.get(tuple(str(value) for value in values))
+        return child.value if child else 0.0
+
+    def render_child(self, values: Tuple[str, ...], child: CounterValue) -> List[str]:
+        labels = render_labels(self.labelnames, values)
+        return [f"{self.name}{labels} {render_value(child.value)}"]
+
+
+class HistogramValue(object):
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q: float) -> float:
+        counts, _, count = self.snapshot()
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def render_child(self, values: Tuple[str, ...], child: HistogramValue) -> List[str]:
+        counts, total, count = child.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            labels = render_labels(
+                self.labelnames + ("le",), values + (render_value(bound),)
+            )
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = render_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {render_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+registry: List[Metric] = []
+
+handler_duration = Histogram(
+    "menstruation_handler_duration_seconds",
+    "Time spent in Telegram update handlers.",
+    ["handler"],
+)
+upstream_duration = Histogram(
+    "menstruation_upstream_request_duration_seconds",
+    "Latency of requests to the menstruation API.",
+    ["endpoint"],
+)
+redis_duration = Histogram(
+    "menstruation_redis_call_duration_seconds",
+    "Latency of user database calls.",
+    ["call"],
+)
+cache_requests = Counter(
+    "menstruation_cache_requests_total",
+    "Cache lookups by cache and result (hit, shared, miss, stale, not_modified).",
+    ["cache", "result"],
+)
+notification_lag = Histogram(
+    "menstruation_notification_lag_seconds",
+    "Delay between a subscriber's notification time and delivery.",
+    buckets=LAG_BUCKETS,
+)
+
+
+def timed(histogram: Histogram):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def timed_coroutine(*args, **kwargs):
+                with histogram.labels(func.__name__).time():
+                    return await func(*args, **kwargs)
+
+            return timed_coroutine
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.labels(func.__name__).time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def render_duration(seconds: float) -> str:
+    if seconds == math.inf:
+        return "∞"
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.1f} s"
+
+
+def summarise_histogram(histogram: Histogram, limit: int = 5) -> List[str]:
+    children = sorted(histogram.series(), key=lambda item: item[1].count, reverse=True)
+    lines = []
+    for values, child in children[:limit]:
+        _, total, count = child.snapshot()
+        if not count:
+            continue
+        lines.append(
+            f"`{' '.join(values) or histogram.name}`: {count}×, "
+            f"Ø {render_duration(total / count)}, "
+            f"p95 ≤ {render_duration(child.quantile(0.95))}"
+        )
+    return lines
+
+
+def summary() -> str:
+    lines = ["Handler:"] + summarise_histogram(handler_duration)
+    lines += ["API:"] + summarise_histogram(upstream_duration)
+    lines += ["Redis:"] + summarise_histogram(redis_duration, limit=3)
+    caches = sorted({values[0] for values, _ in cache_requests.series()})
+    for cache in caches:
+        hits = cache_requests.total(cache, "hit") + cache_requests.total(
+            cache, "shared"
+        )
+        misses = cache_requests.total(cache, "miss")
+        if hits + misses:
+            lines.append(
+                f"Cache {cache}: {hits / (hits + misses):.0%} Treffer "
+                f"({hits:.0f} / {hits + misses:.0f})"
+            )
+    lag = notification_lag.labels()
+    if lag.count:
+        lines.append(
+            f"Abo-Verzögerung: Ø {render_duration(lag.sum / lag.count)}, "
+            f"p95 ≤ {render_duration(lag.quantile(0.95))}"
+        )
+    return "\n".join(lines)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0].rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics {self.address_string()}: {format % args}")
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def start_server(listen: str, port: int) -> Optional[MetricsServer]:
+    if not port:
+        return None
+    server = MetricsServer((listen, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on {listen}:{port}/metrics")
+    return server
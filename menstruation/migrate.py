@@ -0,0 +1,82 @@
+import logging
+from itertools import islice
+from typing import Callable, List
+
+from menstruation import config
+from menstruation.config import UserDatabase, allergens_key
+
+
+def allergens_to_sets(user_db: UserDatabase) -> int:
+    migrated = 0
+    user_ids = user_db.iter_users()
+    while True:
+        batch = list(islice(user_ids, user_db.BATCH_SIZE))
+        if not batch:
+            return migrated
+        pipeline = user_db.redis.pipeline(transaction=False)
+        for user_id in batch:
+            pipeline.hget(str(user_id), "allergens")
+        values = pipeline.execute()
+        pipeline = user_db.redis.pipeline(transaction=False)
+        for user_id, value in zip(batch, values):
+            if value is None:
+                continue
+            allergens = [allergen for allergen in value.split(",") if allergen]
+            if allergens:
+                pipeline.sadd(allergens_key(user_id), *allergens)
+            pipeline.hdel(str(user_id), "allergens")
+            migrated += 1
+        pipeline.execute()
+
+
+def default_time_to_set(user_db: UserDatabase) -> int:
+    migrated = 0
+    user_ids = (
+        int(user_id_str)
+        for user_id_str, _ in user_db.redis.zscan_iter(
+            user_db.SCHEDULE_KEY, count=user_db.BATCH_SIZE
+        )
+    )
+    while True:
+        batch = list(islice(user_ids, user_db.BATCH_SIZE))
+        if not batch:
+            return migrated
+        pipeline = user_db.redis.pipeline(transaction=False)
+        for user_id in batch:
+            pipeline.hget(str(user_id), "subscription_time")
+        values = pipeline.execute()
+        pipeline = user_db.redis.pipeline(transaction=False)
+        for user_id, value in zip(batch, values):
+            if value:
+                continue
+            pipeline.zrem(user_db.SCHEDULE_KEY, str(user_id))
+            pipeline.sadd(user_db.DEFAULT_SCHEDULE_KEY, str(user_id))
+            migrated += 1
+        pipeline.execute()
+
+
+# MIGRATIONS[n] upgrades the schema from version n + 1 to n + 2.
+MIGRATIONS: List[Callable[[UserDatabase], int]] = [
+    allergens_to_sets,
+    default_time_to_set,
+]
+
+
+def migrate(user_db: UserDatabase) -> None:
+    version = user_db.schema_version()
+    while version < user_db.SCHEMA_VERSION:
+        step = MIGRATIONS[version - 1]
+        logging.info(f"Migrating schema from version {version}: {step.__name__}")
+        migrated = step(user_db)
+        version += 1
+        user_db.set_schema_version(version)
+        logging.info(f"Migrated {migrated} users to schema version {version}")
+
+
+def main():
+    with config.user_db.redis.lock("index_lock", timeout=600):
+        migrate(config.user_db)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
+import functools
 import logging
 import re
 from datetime import date, datetime, timedelta
 from enum import Enum
-from typing import Optional, Set, Dict, Union, List
+from typing import Optional, Set, Dict, Union, List, Tuple, FrozenSet
 
 
 class Color(Enum):
@@ -12,24 +13,13 @@ class Color(Enum):
 
     @staticmethod
     def from_text(text: str) -> "Color":
-        if text == "green":
-            return Color.GREEN
-        elif text == "yellow":
-            return Color.YELLOW
-        elif text == "red":
-            return Color.RED
-        else:
-            raise ValueError(f"{text} is no valid color")
+        try:
+            return COLOR_TEXTS[text]
+        except KeyError:
+            raise ValueError(f"{text} is no valid color") from None
 
     def __str__(self: "Color") -> str:
-        if self == Color.GREEN:
-            return "green"
-        elif self == Color.YELLOW:
-            return "yellow"
-        elif self == Color.RED:
-            return "red"
-        else:
-            raise ValueError("unreachable")
+        return COLOR_NAMES[self]
 
 
 class Tag(Enum):
@@ -53,72 +43,71 @@ class Tag(Enum):
 
     @staticmethod
     def from_text(text: str) -> "Tag":
-        if text == "vegetarian":
-            return Tag.VEGETARIAN
-        elif text == "vegan":
-            return Tag.VEGAN
-        elif text == "organic":
-            return Tag.ORGANIC
-        elif text == "sustainable fishing":
-            return Tag.SUSTAINABLE_FISHING
-        elif text == "climate friendly":
-            return Tag.CLIMATE_FRIENDLY
-        elif text == "H2O A":
-            return Tag.H2O_A
-        elif text == "H2O B":
-            return Tag.H2O_B
-        elif text == "H2O C":
-            return Tag.H2O_C
-        elif text == "H2O D":
-            return Tag.H2O_D
-        elif text == "H2O E":
-            return Tag.H2O_E
-        elif text == "CO2 A":
-            return Tag.CO2_A
-        elif text == "CO2 B":
-            return Tag.CO2_B
-        elif text == "CO2 C":
-            return Tag.CO2_C
-        elif text == "CO2 D":
-            return Tag.CO2_D
-        elif text == "CO2 E":
-            return Tag.CO2_E
-        else:
-            raise ValueError(f"{text} is no valid tag")
+        try:
+            return TAG_TEXTS[text]
+        except KeyError:
+            raise ValueError(f"{text} is no valid tag") from None
 
     def __str__(self: "Tag") -> str:
-        if self == Tag.VEGETARIAN:
-            return "vegetarian"
-        elif self == Tag.VEGAN:
-            return "vegan"
-        elif self == Tag.ORGANIC:
-            return "organic"
-        elif self == Tag.SUSTAINABLE_FISHING:
-            return "sustainable fishing"
-        elif self == Tag.CLIMATE_FRIENDLY:
-            return "climate friendly"
-        elif self == Tag.H2O_A:
-            return "H2O A"
-        elif self == Tag.H2O_B:
-            return "H2O B"
-        elif self == Tag.H2O_C:
-            return "H2O C"
-        elif self == Tag.H2O_D:
-            return "H2O D"
-        elif self == Tag.H2O_E:
-            return "H2O E"
-        elif self == Tag.CO2_A:
-            return "CO2 A"
-        elif self == Tag.CO2_B:
-            return "CO2 B"
-        elif self == Tag.CO2_C:
-            return "CO2 C"
-        elif self == Tag.CO2_D:
-            return "CO2 D"
-        elif self == Tag.CO2_E:
-            return "CO2 E"
-        else:
-            raise ValueError("unreachable")
+        return TAG_NAMES[self]
+
+
+COLOR_TEXTS: Dict[str, Color] = {
+    "green": Color.GREEN,
+    "yellow": Color.YELLOW,
+    "red": Color.RED,
+}
+
+TAG_TEXTS: Dict[str, Tag] = {
+    "vegetarian": Tag.VEGETARIAN,
+    "vegan": Tag.VEGAN,
+    "organic": Tag.ORGANIC,
+    "sustainable fishing": Tag.SUSTAINABLE_FISHING,
+    "climate friendly": Tag.CLIMATE_FRIENDLY,
+    "H2O A": Tag.H2O_A,
+    "H2O B": Tag.H2O_B,
+    "H2O C": Tag.H2O_C,
+    "H2O D": Tag.H2O_D,
+    "H2O E": Tag.H2O_E,
+    "CO2 A": Tag.CO2_A,
+    "CO2 B": Tag.CO2_B,
+    "CO2 C": Tag.CO2_C,
+    "CO2 D": Tag.CO2_D,
+    "CO2 E": Tag.CO2_E,
+}
+
+# The H2O and CO2 ratings share an empty emoji, so they are aliases of H2O_A
+# and the first name listed wins.
+COLOR_NAMES: Dict[Color, str] = dict()
+for name, color in COLOR_TEXTS.items():
+    COLOR_NAMES.setdefault(color, name)
+TAG_NAMES: Dict[Tag, str] = dict()
+for name, tag in TAG_TEXTS.items():
+    TAG_NAMES.setdefault(tag, name)
+
+RELATIVE_DAYS = dict(today=0, tomorrow=1)
+WEEKDAYS = dict(mo=0, di=1, mi=2, do=3, fr=4, sa=5, so=6)
+WEEK = (WEEKDAYS["mo"], WEEKDAYS["fr"])
+
+TOKEN_PATTERN = re.compile(
+    r"(?P<date>\d{4}-\d{2}-\d{2}|today|tomorrow)"
+    r"|(?i:\b(?P<week>week|woche)\b)"
+    r"|(?i:(?P<days>\b(?P<weekday>mo|di|mi|do|fr|sa|so)\b"
+    r"(?:\s*-\s*\b(?P<last>mo|di|mi|do|fr|sa|so)\b)?))"
+    r"|(?<![\d.,-])(?P<price>\d+(?:[,.]\d*)?)\s?€"
+    r"|(?P<color>:green_heart:|:yellow_heart:|:red_heart:)"
+    r"|(?P<tag>:carrot:|:seedling:|:smiling_face_with_halo:|:fish:|:globe_showing_Americas:)"
+)
+# "so", "do" and "mi" are ordinary words, too, so a single weekday only
+# counts if nothing but filter tokens is left around it.
+STRAY_WORD = re.compile(r"\w")
+
+
+def allergen_number(allergen: Union[str, dict]) -> str:
+    if isinstance(allergen, dict):
+        return f"{allergen['number']}{allergen.get('index') or ''}"
+    else:
+        return str(allergen)
 
 
 class Query:
@@ -129,66 +118,139 @@ class Query:
         tags: Set[Tag],
         date: Optional[date],
         allergens: Set[str],
+        until: Optional[date] = None,
     ) -> None:
         self.max_price = max_price
         self.tags: Set[Tag] = tags
         self.colors: Set[Color] = colors
         self.date = date
+        self.until = until
         self.allergens = allergens
 
-    def params(self: "Query") -> Dict[str, Union[str, List[str]]]:
-        params: Dict[str, Union[str, List[str]]] = dict()
-        if self.date:
-            params["date"] = self.date.isoformat()
-        if self.max_price:
-            params["max_price"] = str(self.max_price)
-        if self.tags:
-            params["tag"] = [str(tag) for tag in self.tags]
-        if self.colors:
-            params["color"] = [str(color) for color in self.colors]
-        if self.allergens:
-            params["allergen"] = [allergen for allergen in self.allergens]
-        return params
+    def effective_date(self: "Query") -> date:
+        return self.date or date.today()
 
-    @staticmethod
-    def from_text(text: str) -> "Query":
-        def extract_date(text: str) -> Optional[date]:
-            matches = re.search(r"(\d{4}-\d{2}-\d{2}|today|tomorrow)", text)
-            if matches:
-                if matches.group(1) == "today":
-                    parsed_date = date.today()
-                elif matches.group(1) == "tomorrow":
-                    parsed_date = date.today() + timedelta(days=1)
-                elif matches.group(1):
-                    parsed_date = datetime.strptime(matches.group(1), "%Y-%m-%d").date()
-                logging.debug(f'Extracted {parsed_date} from "{text}"')
-                return parsed_date
-            else:
-                logging.debug(f"No date found in '{text}'")
-                return None
+    def dates(self: "Query") -> List[date]:
+        first = self.effective_date()
+        days = (self.until - first).days + 1 if self.until else 1
+        return [first + timedelta(days=n) for n in range(max(days, 1))]
+
+    def on(self: "Query", day: date) -> "Query":
+        return Query(
+            max_price=self.max_price,
+            colors=self.colors,
+            tags=self.tags,
+            date=day,
+            allergens=self.allergens,
+        )
+
+    def key(self: "Query") -> Tuple:
+        return (
+            self.effective_date().isoformat(),
+            self.until.isoformat() if self.until else None,
+            self.max_price or None,
+            tuple(sorted(str(color) for color in self.colors)),
+            tuple(sorted(str(tag) for tag in self.tags)),
+            tuple(sorted(self.allergens)),
+        )
+
+    def matches(self: "Query", meal: dict) -> bool:
+        if self.max_price and meal["price"]:
+            if meal["price"]["student"] > self.max_price:
+                return False
+        if self.colors and Color.from_text(meal["color"]) not in self.colors:
+            return False
+        if self.tags and self.tags.isdisjoint(
+            Tag.from_text(tag) for tag in meal["tags"]
+        ):
+            return False
+        if self.allergens and not self.allergens.isdisjoint(
+            allergen_number(allergen) for allergen in meal.get("allergens") or []
+        ):
+            return False
+        return True
 
-        max_price_result = re.search(r"(\d+,?\d*)\s?€", text)
-        # logging.info('Extracted {} from "{}"'.format((max_price, colors, tags), text))
+    def filter(self: "Query", groups: List[dict]) -> List[dict]:
+        return [
+            dict(group, items=[meal for meal in group["items"] if self.matches(meal)])
+            for group in groups
+        ]
 
+    @staticmethod
+    def from_text(text: str) -> "Query":
+        max_price, colors, tags, parsed_date = parse_filter(text)
+        until = None
+        if isinstance(parsed_date, str):
+            parsed_date = date.today() + timedelta(days=RELATIVE_DAYS[parsed_date])
+        elif isinstance(parsed_date, tuple):
+            parsed_date, until = weekday_range(date.today(), *parsed_date)
+        logging.debug(f'Extracted {parsed_date}–{until} from "{text}"')
         return Query(
-            max_price=(
-                int(float(max_price_result.group(1).replace(",", ".")) * 100)
-                if max_price_result
-                else None
-            ),
-            colors=set(
-                Color(emoji)
-                for emoji in re.findall(
-                    r"(:green_heart:|:yellow_heart:|:red_heart:)", text
-                )
-            ),
-            tags=set(
-                Tag(emoji)
-                for emoji in re.findall(
-                    r"(:carrot:|:seedling:|:smiling_face_with_halo:|:fish:|:globe_showing_Americas:)",
-                    text,
-                )
-            ),
-            date=extract_date(text),
+            max_price=max_price,
+            colors=set(colors),
+            tags=set(tags),
+            date=parsed_date,
             allergens=set(),
+            until=until,
         )
+
+
+def weekday_range(today: date, first: int, last: int) -> Tuple[date, Optional[date]]:
+    monday = today - timedelta(days=today.weekday())
+    if today.weekday() > last:
+        monday += timedelta(weeks=1)
+    start = max(today, monday + timedelta(days=first))
+    end = monday + timedelta(days=last)
+    return start, end if end > start else None
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_filter(
+    text: str,
+) -> Tuple[
+    Optional[int],
+    FrozenSet[Color],
+    FrozenSet[Tag],
+    Union[date, str, Tuple[int, int], None],
+]:
+    max_price: Optional[int] = None
+    colors: Set[Color] = set()
+    tags: Set[Tag] = set()
+    parsed_date: Union[date, str, Tuple[int, int], None] = None
+    weekday: Optional[int] = None
+    found_price = found_date = False
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind == "date" and not found_date:
+            found_date = True
+            token = match.group("date")
+            if token in RELATIVE_DAYS:
+                parsed_date = token
+            else:
+                parsed_date = datetime.strptime(token, "%Y-%m-%d").date()
+        elif kind == "week" and not found_date:
+            found_date = True
+            parsed_date = WEEK
+        elif kind == "days" and not found_date:
+            first = WEEKDAYS[match.group("weekday").lower()]
+            if match.group("last"):
+                found_date = True
+                last = WEEKDAYS[match.group("last").lower()]
+                parsed_date = (min(first, last), max(first, last))
+            elif weekday is None:
+                weekday = first
+        elif kind == "price" and not found_price:
+            found_price = True
+            price = match.group("price").replace(",", ".")
+            max_price = round(float(price) * 100) or None
+        elif kind == "color":
+            colors.add(Color(match.group("color")))
+        elif kind == "tag":
+            tags.add(Tag(match.group("tag")))
+    if (
+        not found_date
+        and weekday is not None
+        and not STRAY_WORD.search(TOKEN_PATTERN.sub("", text))
+    ):
+        parsed_date = (weekday, weekday)
+    return max_price, frozenset(colors), frozenset(tags), parsed_date
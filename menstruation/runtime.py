@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Coroutine, Iterable, List
+
+from menstruation import config
+
+
+class EventLoop(object):
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        # blocking calls that have no asyncio counterpart, like python-telegram-bot's
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(
+                max_workers=config.workers, thread_name_prefix="loop-executor"
+            )
+        )
+        self.thread = threading.Thread(target=self.run, name="event-loop", daemon=True)
+        self.lock = threading.Lock()
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self) -> None:
+        with self.lock:
+            if not self.thread.is_alive():
+                self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def submit(self, coroutine: Coroutine) -> Future:
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call(self, coroutine: Coroutine) -> Any:
+        if threading.current_thread() is self.thread:
+            coroutine.close()
+            raise RuntimeError("Blocking on the event loop from inside it")
+        return self.submit(coroutine).result()
+
+
+loop = EventLoop()
+
+
+async def gather(awaitables: Iterable[Awaitable]) -> List[Any]:
+    return await asyncio.gather(*awaitables, return_exceptions=True)
+
+
+async def in_thread(func: Callable, *args, **kwargs) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs)
+    )
+
+
+def log_failure(name: str, future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"{name} failed", exc_info=future.exception())
+
+
+def handler(func: Callable[..., Coroutine]) -> Callable[..., Future]:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs) -> Future:
+        future = loop.submit(func(*args, **kwargs))
+        future.add_done_callback(functools.partial(log_failure, func.__name__))
+        return future
+
+    return wrapper
@@ -0,0 +1,227 @@
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from cachetools import TTLCache
+from telegram import Bot
+from telegram.error import RetryAfter
+
+INTERACTIVE = 0
+BULK = 1
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float) -> None:
+        self.refill(now)
+        self.tokens -= 1
+
+
+class Message(object):
+    def __init__(
+        self, priority: int, seq: int, chat_id: int, func: Callable, args, kwargs
+    ) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future = Future()
+
+    def __lt__(self, other: "Message") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class MessageQueue(object):
+    GLOBAL_RATE = 30
+    CHAT_RATE = 1
+    CHAT_BURST = 3
+    WORKERS = 4
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.global_bucket = TokenBucket(self.GLOBAL_RATE, 1)
+        self.chat_buckets: Dict[int, TokenBucket] = TTLCache(
+            maxsize=1_000_000, ttl=self.CHAT_BURST / self.CHAT_RATE, timer=monotonic
+        )
+        self.chat_queues: Dict[int, List[Message]] = dict()
+        self.ready: List[Tuple[int, int, int]] = []
+        self.waiting: List[Tuple[float, int]] = []
+        self.waiting_chats: Set[int] = set()
+        # chats with a message handed to a worker; their next message waits
+        # until it is delivered, so messages to one chat keep their order
+        self.sending: Set[int] = set()
+        self.paused_until = 0.0
+        self.threads: List[threading.Thread] = []
+        self.running = False
+
+    def start(self) -> None:
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.threads = [
+                threading.Thread(target=self.work, name=f"sender_{n}", daemon=True)
+                for n in range(self.WORKERS)
+            ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def pending(self) -> int:
+        with self.condition:
+            return sum(len(queue) for queue in self.chat_queues.values())
+
+    def submit(
+        self, chat_id: int, priority: int, func: Callable, /, *args, **kwargs
+    ) -> Future:
+        if not self.running:
+            self.start()
+        message = Message(priority, next(self.counter), chat_id, func, args, kwargs)
+        with self.condition:
+            self.enqueue(message)
+            self.condition.notify()
+        return message.future
+
+    def enqueue(self, message: Message) -> None:
+        queue = self.chat_queues.setdefault(message.chat_id, [])
+        heapq.heappush(queue, message)
+        if (
+            queue[0] is message
+            and message.chat_id not in self.waiting_chats
+            and message.chat_id not in self.sending
+        ):
+            heapq.heappush(self.ready, (message.priority, message.seq, message.chat_id))
+
+    def next_message(self) -> Tuple[Optional[Message], Optional[float]]:
+        now = monotonic()
+        if now < self.paused_until:
+            return None, self.paused_until - now
+        while self.waiting and self.waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self.waiting)
+            self.waiting_chats.discard(chat_id)
+            queue = self.chat_queues.get(chat_id)
+            if queue and chat_id not in self.sending:
+                heapq.heappush(self.ready, (queue[0].priority, queue[0].seq, chat_id))
+        while self.ready:
+            priority, seq, chat_id = self.ready[0]
+            queue = self.chat_queues.get(chat_id)
+            if (
+                not queue
+                or chat_id in self.sending
+                or (queue[0].priority, queue[0].seq) != (priority, seq)
+            ):
+                heapq.heappop(self.ready)
+                continue
+            chat_bucket = self.chat_bucket(chat_id)
+            chat_delay = chat_bucket.delay(now)
+            if chat_delay > 0:
+                heapq.heappop(self.ready)
+                self.wait_for(chat_id, now + chat_delay)
+                continue
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                return None, global_delay
+            heapq.heappop(self.ready)
+            message = heapq.heappop(queue)
+            self.global_bucket.take(now)
+            chat_bucket.take(now)
+            self.chat_buckets[chat_id] = chat_bucket
+            if not queue:
+                del self.chat_queues[chat_id]
+            self.sending.add(chat_id)
+            return message, None
+        if self.waiting:
+            return None, self.waiting[0][0] - now
+        return None, None
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(
+                self.CHAT_RATE, self.CHAT_BURST
+            )
+        return bucket
+
+    def delivered(self, chat_id: int) -> None:
+        self.sending.discard(chat_id)
+        queue = self.chat_queues.get(chat_id)
+        if not queue or chat_id in self.waiting_chats:
+            return
+        now = monotonic()
+        delay = self.chat_bucket(chat_id).delay(now)
+        if delay > 0:
+            self.wait_for(chat_id, now + delay)
+        else:
+            heapq.heappush(self.ready, (queue[0].priority, queue[0].seq, chat_id))
+        self.condition.notify()
+
+    def wait_for(self, chat_id: int, ready_at: float) -> None:
+        if chat_id not in self.waiting_chats:
+            self.waiting_chats.add(chat_id)
+            heapq.heappush(self.waiting, (ready_at, chat_id))
+
+    def work(self) -> None:
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                message, timeout = self.next_message()
+                if message is None:
+                    self.condition.wait(timeout)
+                    continue
+            try:
+                self.deliver(message)
+            finally:
+                with self.condition:
+                    self.delivered(message.chat_id)
+
+    def deliver(self, message: Message) -> None:
+        try:
+            result = message.func(*message.args, **message.kwargs)
+        except RetryAfter as err:
+            logging.warning(f"Flood control, pausing sends for {err.retry_after}s")
+            with self.condition:
+                self.paused_until = max(
+                    self.paused_until, monotonic() + float(err.retry_after)
+                )
+                self.enqueue(message)
+                self.condition.notify_all()
+            return
+        except Exception as err:
+            logging.warning(f"Sending to {message.chat_id} failed: {err}")
+            message.future.set_exception(err)
+            return
+        message.future.set_result(result)
+
+
+outbox = MessageQueue()
+
+
+def send_message(
+    bot: Bot, chat_id: int, text: str, priority: int = INTERACTIVE, **kwargs
+) -> Future:
+    return outbox.submit(chat_id, priority, bot.send_message, chat_id, text, **kwargs)
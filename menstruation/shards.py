@@ -0,0 +1,141 @@
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import uuid
+from datetime import datetime
+from time import monotonic, time
+from typing import Set, Dict, Optional, Iterable
+
+import redis
+
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+else
+    return 0
+end
+"""
+
+
+class PartitionLeases(object):
+    LEASE_PREFIX = "lease:"
+    INSTANCES_KEY = "instances"
+    CURSORS_KEY = "dispatch_cursors"
+
+    def __init__(self, redis_client: redis.Redis, partitions: int, ttl: int) -> None:
+        self.redis = redis_client
+        self.partitions = partitions
+        self.ttl = ttl
+        self.instance = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # partition -> monotonic() deadline after which the lease may have
+        # been claimed by another instance
+        self.owned: Dict[int, float] = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.renew_script = self.redis.register_script(RENEW_SCRIPT)
+        self.release_script = self.redis.register_script(RELEASE_SCRIPT)
+
+    def partition_of(self, user_id: int) -> int:
+        return user_id % self.partitions
+
+    def owns(self, user_id: int) -> bool:
+        return self.partition_of(user_id) in self.owned_partitions()
+
+    def owned_partitions(self) -> Set[int]:
+        now = monotonic()
+        with self.lock:
+            return {
+                partition for partition, expires in self.owned.items() if expires > now
+            }
+
+    def start(self) -> None:
+        self.heartbeat()
+        self.thread = threading.Thread(target=self.run, name="heartbeat", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.ttl / 3):
+            try:
+                self.heartbeat()
+            except Exception as err:
+                logging.exception(f"Heartbeat failed: {err}")
+
+    def heartbeat(self) -> None:
+        expires = monotonic() + self.ttl
+        now = time()
+        pipeline = self.redis.pipeline()
+        pipeline.zadd(self.INSTANCES_KEY, {self.instance: now})
+        pipeline.zremrangebyscore(self.INSTANCES_KEY, "-inf", now - self.ttl)
+        pipeline.zcard(self.INSTANCES_KEY)
+        live_instances = pipeline.execute()[-1]
+        fair_share = math.ceil(self.partitions / max(live_instances, 1))
+
+        with self.lock:
+            held = sorted(self.owned)
+        owned: Set[int] = set()
+        for partition in held:
+            if self.renew_script(
+                keys=[self.lease_key(partition)], args=[self.instance, self.ttl * 1000]
+            ):
+                owned.add(partition)
+            else:
+                logging.warning(f"Lost lease on partition {partition}")
+        while len(owned) > fair_share:
+            partition = owned.pop()
+            self.release_script(keys=[self.lease_key(partition)], args=[self.instance])
+            logging.info(f"Released partition {partition} for rebalancing")
+        free = [
+            partition for partition in range(self.partitions) if partition not in owned
+        ]
+        random.shuffle(free)
+        for partition in free:
+            if len(owned) >= fair_share:
+                break
+            if self.redis.set(
+                self.lease_key(partition), self.instance, nx=True, px=self.ttl * 1000
+            ):
+                logging.info(f"Claimed partition {partition}")
+                owned.add(partition)
+        with self.lock:
+            self.owned = {partition: expires for partition in owned}
+
+    def release(self) -> None:
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            owned, self.owned = set(self.owned), dict()
+        for partition in owned:
+            self.release_script(keys=[self.lease_key(partition)], args=[self.instance])
+        self.redis.zrem(self.INSTANCES_KEY, self.instance)
+        logging.info(f"Released partitions {sorted(owned)}")
+
+    def cursors(self, partitions: Iterable[int]) -> Dict[int, Optional[datetime]]:
+        partitions = list(partitions)
+        if not partitions:
+            return dict()
+        values = self.redis.hmget(self.CURSORS_KEY, [str(p) for p in partitions])
+        return {
+            partition: datetime.fromisoformat(value) if value else None
+            for partition, value in zip(partitions, values)
+        }
+
+    def set_cursors(self, partitions: Iterable[int], cursor: datetime) -> None:
+        mapping = {str(partition): cursor.isoformat() for partition in partitions}
+        if mapping:
+            self.redis.hset(self.CURSORS_KEY, mapping=mapping)
+
+    def lease_key(self, partition: int) -> str:
+        return f"{self.LEASE_PREFIX}{partition}"
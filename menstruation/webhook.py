@@ -0,0 +1,93 @@
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from typing import Optional
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+from menstruation import config
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        listen: str,
+        port: int,
+        path: str,
+        secret: Optional[str],
+        bot: Bot,
+        update_queue: Queue,
+    ) -> None:
+        super().__init__((listen, port), WebhookRequestHandler)
+        self.path = "/" + path.strip("/")
+        self.secret = secret
+        self.bot = bot
+        self.update_queue = update_queue
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: WebhookServer
+
+    def do_POST(self):
+        if self.path.rstrip("/") != self.server.path.rstrip("/"):
+            self.send_error(404)
+            return
+        if self.server.secret and not hmac.compare_digest(
+            self.headers.get(SECRET_HEADER, ""), self.server.secret
+        ):
+            logging.warning(f"Rejected webhook call from {self.client_address[0]}")
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length).decode())
+            update = Update.de_json(data, self.server.bot)
+        except Exception as err:
+            logging.debug(f"Malformed webhook update: {err}")
+            self.send_error(400)
+            return
+        if update:
+            logging.debug(f"Received update {update.update_id} on webhook")
+            self.server.update_queue.put(update)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug(f"Webhook {self.address_string()}: {format % args}")
+
+
+def start_dispatcher(updater: Updater) -> None:
+    updater.running = True
+    threading.Thread(
+        target=updater.dispatcher.start, name="dispatcher", daemon=True
+    ).start()
+
+
+def start_webhook(updater: Updater) -> WebhookServer:
+    server = WebhookServer(
+        config.webhook_listen,
+        config.webhook_port,
+        config.webhook_path,
+        config.webhook_secret,
+        updater.bot,
+        updater.update_queue,
+    )
+    start_dispatcher(updater)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    logging.info(
+        f"Listening for updates on {config.webhook_listen}:{config.webhook_port}{server.path}"
+    )
+    if config.webhook_url:
+        updater.bot.set_webhook(
+            url=config.webhook_url, secret_token=config.webhook_secret
+        )
+    return server
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import fakeredis
+import pytest
+
+from menstruation import broadcast, config, sender
+
+MODERATOR = 1
+
+
+class Message(object):
+    def __init__(self, message_id: int) -> None:
+        self.message_id = message_id
+
+
+class Bot(object):
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.sent = []
+        self.lock = threading.Lock()
+        self.on_send = None
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+        if self.on_send:
+            self.on_send()
+        with self.lock:
+            self.sent.append(chat_id)
+            return Message(len(self.sent))
+
+    def edit_message_text(self, text, **kwargs):
+        return Message(kwargs.get("message_id", 0))
+
+
+class JobQueue(object):
+    def __init__(self) -> None:
+        self.scheduled = []
+
+    def run_once(self, callback, when, context=None, name=None):
+        self.scheduled.append((callback, when, context))
+
+
+class Job(object):
+    def __init__(self, context) -> None:
+        self.context = context
+
+
+class Context(object):
+    def __init__(self, bot: Bot, job_queue: JobQueue, broadcast_id: str) -> None:
+        self.bot = bot
+        self.job_queue = job_queue
+        self.job = Job(broadcast_id)
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(config.user_db, "redis", client)
+    return client
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    queue = sender.MessageQueue()
+    monkeypatch.setattr(sender, "outbox", queue)
+    yield queue
+    queue.stop()
+
+
+def add_users(redis_client, count: int) -> None:
+    redis_client.sadd(config.user_db.USERS_KEY, *range(1, count + 1))
+
+
+def start(redis_client, bot: Bot) -> str:
+    job_queue = JobQueue()
+    broadcast_id = broadcast.start_broadcast(job_queue, bot, MODERATOR, "Hallo")
+    bot.sent.clear()
+    return broadcast_id
+
+
+def test_total_excludes_the_moderator(redis_client, outbox):
+    add_users(redis_client, 10)
+    broadcast_id = start(redis_client, Bot())
+    state = redis_client.hgetall(broadcast.broadcast_key(broadcast_id))
+    assert state["total"] == "9"
+
+
+def test_lock_is_extended_while_a_batch_is_delivered(redis_client, outbox, monkeypatch):
+    monkeypatch.setattr(broadcast, "LOCK_TIMEOUT", 0.3)
+    add_users(redis_client, 20)
+    bot = Bot(latency=0.05)
+    broadcast_id = start(redis_client, bot)
+    job_queue = JobQueue()
+    started = time.monotonic()
+    broadcast.run_broadcast(Context(bot, job_queue, broadcast_id))
+    assert time.monotonic() - started > broadcast.LOCK_TIMEOUT
+    assert sorted(bot.sent) == list(range(2, 21))
+    assert not redis_client.sismember(broadcast.BROADCASTS_KEY, broadcast_id)
+    assert job_queue.scheduled == []
+
+
+def test_lost_lock_yields_and_retries_later(redis_client, outbox):
+    add_users(redis_client, 5)
+    bot = Bot()
+    broadcast_id = start(redis_client, bot)
+    lock_key = f"{broadcast.broadcast_key(broadcast_id)}:lock"
+    bot.on_send = lambda: redis_client.delete(lock_key)
+    job_queue = JobQueue()
+    broadcast.run_broadcast(Context(bot, job_queue, broadcast_id))
+    assert redis_client.sismember(broadcast.BROADCASTS_KEY, broadcast_id)
+    assert job_queue.scheduled == [
+        (broadcast.run_broadcast, broadcast.LOCK_TIMEOUT, broadcast_id)
+    ]
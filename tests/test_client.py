@@ -0,0 +1,82 @@
+import os
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import httpx
+import pytest
+
+import menstruation.client as client
+from menstruation import runtime
+from menstruation.client import CircuitBreaker, CircuitOpenError, UpstreamError
+
+URL = "http://mensa.test/menu?mensa=1&date=2021-11-03"
+
+
+class Api(object):
+    def __init__(self, status_code: int, content: bytes) -> None:
+        self.status_code = status_code
+        self.content = content
+        self.calls = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        return httpx.Response(self.status_code, content=self.content)
+
+
+@pytest.fixture
+def breakers(monkeypatch):
+    monkeypatch.setattr(client, "breakers", dict())
+    monkeypatch.setattr(client, "RETRY_BACKOFF", 0)
+
+
+def use_api(monkeypatch, status_code: int, content: bytes) -> Api:
+    api = Api(status_code, content)
+    monkeypatch.setattr(
+        client, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(api))
+    )
+    return api
+
+
+def get(url: str, **kwargs):
+    return runtime.loop.call(client.get(url, **kwargs))
+
+
+def test_json_body_closes_the_circuit(monkeypatch, breakers):
+    use_api(monkeypatch, 200, b'[{"name": "Essen"}]')
+    response, body = get(URL)
+    assert body == [{"name": "Essen"}]
+    assert client.breaker_for(URL).is_closed()
+
+
+def test_maintenance_page_opens_the_circuit(monkeypatch, breakers):
+    api = use_api(monkeypatch, 200, b"<html>Wartung</html>")
+    for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+        with pytest.raises(ValueError):
+            get(URL)
+    with pytest.raises(CircuitOpenError):
+        get(URL)
+    assert api.calls == CircuitBreaker.FAILURE_THRESHOLD
+
+
+def test_client_errors_do_not_open_the_circuit(monkeypatch, breakers):
+    use_api(monkeypatch, 404, b"Not Found")
+    for _ in range(CircuitBreaker.FAILURE_THRESHOLD + 1):
+        with pytest.raises(ValueError):
+            get(URL)
+    assert client.breaker_for(URL).is_closed()
+
+
+def test_server_errors_are_retried_then_raised(monkeypatch, breakers):
+    api = use_api(monkeypatch, 503, b"Service Unavailable")
+    with pytest.raises(UpstreamError):
+        get(URL)
+    assert api.calls == client.RETRIES + 1
+    assert client.breaker_for(URL).failures == 1
+
+
+def test_not_modified_has_no_body(monkeypatch, breakers):
+    use_api(monkeypatch, 304, b"")
+    response, body = get(URL, headers={"If-None-Match": '"abc"'})
+    assert response.status_code == 304
+    assert body is None
+    assert client.breaker_for(URL).is_closed()
@@ -0,0 +1,53 @@
+import os
+from datetime import time
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import fakeredis
+import pytest
+
+from menstruation import config
+from menstruation.config import TOGGLE_SCRIPT, UserDatabase, allergens_key
+
+
+@pytest.fixture
+def user_db():
+    user_db = UserDatabase("localhost")
+    user_db.redis = fakeredis.FakeRedis(decode_responses=True)
+    user_db.toggle_script = user_db.redis.register_script(TOGGLE_SCRIPT)
+    return user_db
+
+
+def test_toggling_an_allergen_turns_it_on_and_off(user_db):
+    assert user_db.toggle_allergen(7, "10a")
+    assert user_db.toggle_allergen(7, "1")
+    assert user_db.profile_of(7).allergens == {"1", "10a"}
+    assert user_db.redis.sismember(user_db.USERS_KEY, "7")
+    assert not user_db.toggle_allergen(7, "10a")
+    assert user_db.profile_of(7).allergens == {"1"}
+    assert not user_db.toggle_allergen(7, "1")
+    assert user_db.profile_of(7).allergens == set()
+    assert not user_db.redis.exists(allergens_key(7))
+
+
+def test_remove_user_deletes_their_allergens(user_db):
+    user_db.set_mensa_for(7, "1")
+    user_db.set_subscription(7, True)
+    user_db.schedule(7, time(11, 30))
+    user_db.toggle_allergen(7, "1")
+    user_db.toggle_allergen(8, "1")
+    assert user_db.remove_user(7)
+    assert not user_db.redis.exists("7", allergens_key(7))
+    assert user_db.user_count() == 1
+    assert user_db.subscriber_count() == 0
+    assert user_db.scheduled_count() == 0
+    assert user_db.profile_of(8).allergens == {"1"}
+
+
+def test_schedule_follows_the_default_time(user_db, monkeypatch):
+    user_db.schedule(7, None)
+    user_db.schedule(8, time(12, 0))
+    monkeypatch.setattr(config, "notification_time", time(10, 0))
+    assert user_db.scheduled_between(time(9, 59), time(10, 0)) == [7]
+    monkeypatch.setattr(config, "notification_time", time(12, 0))
+    assert sorted(user_db.scheduled_between(time(12, 0), time(12, 0))) == [7, 8]
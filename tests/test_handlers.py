@@ -0,0 +1,112 @@
+import asyncio
+import os
+from concurrent.futures import Future
+from datetime import date, timedelta
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+from emoji import emojize
+
+import menstruation.client as client
+from menstruation import jobs  # noqa: F401, handlers needs jobs imported first
+from menstruation import config, handlers, sender
+
+MENU = [
+    dict(
+        name="Essen",
+        items=[dict(name="Linsen", color="green", tags=["vegan"], price=None)],
+    )
+]
+
+
+class Message(object):
+    def __init__(self, chat_id: int) -> None:
+        self.chat_id = chat_id
+
+
+class Update(object):
+    def __init__(self, chat_id: int) -> None:
+        self.effective_message = self.message = Message(chat_id)
+
+
+class Context(object):
+    def __init__(self, *args: str) -> None:
+        self.args = list(args)
+        self.bot = None
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        config.user_db,
+        "redis",
+        fakeredis.FakeRedis(server=server, decode_responses=True),
+    )
+    monkeypatch.setattr(
+        config.async_user_db,
+        "redis",
+        fakeredis.aioredis.FakeRedis(server=server, decode_responses=True),
+    )
+    sent = []
+
+    def send_message(bot, chat_id, text, **kwargs):
+        sent.append(text)
+        future = Future()
+        future.set_result(None)
+        return future
+
+    monkeypatch.setattr(sender, "send_message", send_message)
+    return sent
+
+
+@pytest.mark.parametrize("text", ["today", "2021-11-03", "mo-fr", "mi", "woche"])
+def test_subscribing_with_a_date_is_rejected(sent, text):
+    handlers.subscribe_handler(Update(7), Context("11:30", text, ":carrot:")).result()
+    profile = config.user_db.profile_of(7)
+    assert not profile.subscribed and profile.subscription_time is None
+    assert config.user_db.scheduled_count() == 0
+    assert "Datum" in sent[0]
+
+
+def test_subscribing_with_free_text_is_accepted(sent):
+    handlers.subscribe_handler(Update(7), Context("11:30", "so", "lecker")).result()
+    profile = config.user_db.profile_of(7)
+    assert profile.subscribed and profile.menu_filter == "so lecker"
+    assert config.user_db.scheduled_count() == 1
+
+
+def test_ranges_show_when_the_oldest_stale_menu_was_fetched(sent):
+    today = date.today()
+    older = client.StaleMenu(MENU, fetched_at=0.0)
+    newer = client.StaleMenu(MENU, fetched_at=86400.0)
+    menus = [(today, newer), (today + timedelta(days=1), older)]
+    handlers.reply_menus(None, 7, menus)
+    assert sent[0].startswith(emojize(handlers.stale_notice(older).strip()))
+
+
+def test_menu_requests_wait_for_the_api_concurrently(sent, monkeypatch):
+    chat_ids = range(1, 51)
+    for chat_id in chat_ids:
+        config.user_db.set_mensa_for(chat_id, "1")
+    in_flight = []
+    peak = []
+
+    async def get_json_async(endpoint, mensa_code, query):
+        in_flight.append(mensa_code)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.05)
+        in_flight.pop()
+        return MENU
+
+    monkeypatch.setattr(client, "get_json_async", get_json_async)
+    futures = [
+        handlers.menu_handler(Update(chat_id), Context()) for chat_id in chat_ids
+    ]
+    for future in futures:
+        future.result(timeout=10)
+    assert len(sent) == len(chat_ids)
+    assert max(peak) == len(chat_ids)
@@ -0,0 +1,89 @@
+import os
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import pytest
+
+import menstruation.client as client
+from menstruation import jobs  # noqa: F401, handlers needs jobs imported first
+from menstruation import handlers, runtime
+from menstruation.query import Query
+
+MENU = [
+    dict(
+        name="Essen",
+        items=[
+            dict(
+                name="Linsen",
+                color="green",
+                tags=["vegan"],
+                price=dict(student=150),
+            )
+        ],
+    ),
+    dict(
+        name="Beilagen",
+        items=[
+            dict(
+                name="Reis",
+                color="green",
+                tags=["vegan"],
+                price=dict(student=50),
+            )
+        ],
+    ),
+    dict(name="Suppen", items=[]),
+]
+
+
+@pytest.fixture
+def menu(monkeypatch):
+    handlers.inline_cache.clear()
+    current = [MENU]
+
+    async def get_json_async(endpoint, code, query):
+        return current[0]
+
+    monkeypatch.setattr(client, "get_json_async", get_json_async)
+    yield current
+    handlers.inline_cache.clear()
+
+
+def inline_results(mensa_code: int, query: Query):
+    return runtime.loop.call(handlers.inline_results(mensa_code, query))
+
+
+def message_texts(articles):
+    return [article.input_message_content.message_text for article in articles]
+
+
+def test_inline_results_skip_empty_groups(menu):
+    articles = inline_results(1, Query.from_text(""))
+    assert [article.title for article in articles] == ["Alles", "Essen", "Beilagen"]
+    assert not any("nicht erreichbar" in text for text in message_texts(articles))
+
+
+def test_stale_menus_keep_their_marker(menu):
+    menu[0] = client.StaleMenu(MENU, fetched_at=0.0)
+    articles = inline_results(1, Query.from_text(""))
+    assert len(articles) == 3
+    assert all("nicht erreichbar" in text for text in message_texts(articles))
+
+
+def test_ranges_get_one_result_per_day(monkeypatch):
+    handlers.inline_cache.clear()
+    query = Query.from_text("mo-fr")
+    days = query.dates()
+
+    async def get_json_range_async(endpoint, code, query):
+        return [
+            (day, ValueError("no menu") if day == days[1] else MENU)
+            for day in query.dates()
+        ]
+
+    monkeypatch.setattr(client, "get_json_range_async", get_json_range_async)
+    articles = inline_results(1, query)
+    assert [article.id for article in articles] == [
+        day.isoformat() for day in days if day != days[1]
+    ]
+    assert all("Linsen" in text for text in message_texts(articles))
@@ -0,0 +1,72 @@
+import os
+import threading
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import fakeredis
+import pytest
+from telegram.error import NetworkError, Unauthorized
+
+import menstruation.client as client
+from menstruation import config, jobs, sender
+
+BLOCKED = 2
+OFFLINE = 3
+
+
+class Bot(object):
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.release.wait(10)
+        if chat_id == BLOCKED:
+            raise Unauthorized("Forbidden: bot was blocked by the user")
+        if chat_id == OFFLINE:
+            raise NetworkError("Connection reset")
+        self.sent.append(chat_id)
+
+
+@pytest.fixture
+def user_db(monkeypatch):
+    monkeypatch.setattr(
+        config.user_db, "redis", fakeredis.FakeRedis(decode_responses=True)
+    )
+
+    async def get_json_async(endpoint, mensa_code, query):
+        return []
+
+    monkeypatch.setattr(client, "get_json_async", get_json_async)
+    queue = sender.MessageQueue()
+    monkeypatch.setattr(sender, "outbox", queue)
+    yield config.user_db
+    queue.stop()
+
+
+def subscribe(user_db, user_id: int) -> None:
+    user_db.set_mensa_for(user_id, "1")
+    user_db.set_subscription(user_id, True)
+    user_db.schedule(user_id, None)
+
+
+def test_notifying_does_not_wait_for_deliveries(user_db, monkeypatch):
+    for user_id in [1, BLOCKED, OFFLINE]:
+        subscribe(user_db, user_id)
+    retried = threading.Event()
+    retries = []
+
+    def schedule_retry(attempts):
+        retries.append(attempts)
+        retried.set()
+
+    monkeypatch.setattr(jobs, "schedule_retry", schedule_retry)
+    bot = Bot()
+    jobs.notify_subscribers(bot, [1, BLOCKED, OFFLINE], {OFFLINE: 1})
+    assert bot.sent == [] and retries == []
+    bot.release.set()
+    assert retried.wait(10)
+    assert bot.sent == [1]
+    assert retries == [{OFFLINE: 2}]
+    assert not user_db.profile_of(BLOCKED).subscribed
+    assert user_db.scheduled_count() == 2
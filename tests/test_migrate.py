@@ -0,0 +1,47 @@
+import os
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import fakeredis
+import pytest
+
+from menstruation import migrate
+from menstruation.config import TOGGLE_SCRIPT, UserDatabase, allergens_key
+
+
+@pytest.fixture
+def user_db():
+    user_db = UserDatabase("localhost")
+    user_db.redis = fakeredis.FakeRedis(decode_responses=True)
+    user_db.toggle_script = user_db.redis.register_script(TOGGLE_SCRIPT)
+    return user_db
+
+
+def test_migrates_version_1_to_3(user_db):
+    redis = user_db.redis
+    redis.hset("1", mapping={"mensa": "1", "allergens": "1,10a,", "subscribed": "yes"})
+    redis.hset(
+        "2",
+        mapping={"mensa": "2", "subscribed": "yes", "subscription_time": "11:30"},
+    )
+    redis.hset("3", mapping={"mensa": "3", "allergens": ""})
+    redis.zadd(user_db.SCHEDULE_KEY, {"1": 540, "2": 690})
+    assert user_db.schema_version() == 1
+
+    migrate.migrate(user_db)
+
+    assert user_db.schema_version() == 3
+    assert redis.smembers(allergens_key(1)) == {"1", "10a"}
+    assert not redis.exists(allergens_key(3))
+    assert not redis.hexists("1", "allergens") and not redis.hexists("3", "allergens")
+    assert user_db.profile_of(1).allergens == {"1", "10a"}
+    assert redis.zrange(user_db.SCHEDULE_KEY, 0, -1) == ["2"]
+    assert redis.smembers(user_db.DEFAULT_SCHEDULE_KEY) == {"1"}
+
+
+def test_migrating_twice_changes_nothing(user_db):
+    user_db.redis.hset("1", mapping={"allergens": "1"})
+    migrate.migrate(user_db)
+    migrate.migrate(user_db)
+    assert user_db.schema_version() == 3
+    assert user_db.profile_of(1).allergens == {"1"}
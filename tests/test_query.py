@@ -0,0 +1,81 @@
+from datetime import date, timedelta
+
+import pytest
+
+from menstruation.query import WEEK, WEEKDAYS, Query, weekday_range
+
+
+def key(text: str, allergens=()) -> tuple:
+    query = Query.from_text(text)
+    query.allergens = set(allergens)
+    return query.key()
+
+
+@pytest.mark.parametrize(
+    "text, equivalent",
+    [
+        ("3€ :seedling: :carrot:", ":carrot: :seedling: 3,00 €"),
+        ("3€ :seedling: :carrot:", ":seedling: :carrot: :seedling: 3.00€"),
+        ("3€", "3.00€"),
+        ("3€", "3,00 €"),
+        ("2,50€", "2.5€"),
+        (":green_heart: :yellow_heart:", ":yellow_heart: :green_heart:"),
+        ("today", ""),
+        (f"{date.today().isoformat()} :carrot:", ":carrot: today"),
+        ("0€", ""),
+        ("0€ :fish:", ":fish:"),
+    ],
+)
+def test_equivalent_inputs_share_a_key(text, equivalent):
+    assert key(text) == key(equivalent)
+
+
+@pytest.mark.parametrize(
+    "text, other",
+    [
+        ("2021-11-03", "2021-11-04"),
+        ("today", "tomorrow"),
+        ("3€", "3,50€"),
+        (":carrot:", ":seedling:"),
+        (":green_heart:", ""),
+    ],
+)
+def test_different_inputs_have_different_keys(text, other):
+    assert key(text) != key(other)
+
+
+def test_allergens_are_part_of_the_key():
+    assert key(":carrot:", ["1", "10a"]) == key(":carrot:", ["10a", "1"])
+    assert key(":carrot:", ["1"]) != key(":carrot:", ["2"])
+    assert key(":carrot:", ["1"]) != key(":carrot:")
+
+
+def test_key_is_hashable():
+    assert {key("3€ :seedling:"): True}[key(":seedling: 3€")]
+
+
+def test_tomorrow_is_resolved_to_a_date():
+    tomorrow = date.today() + timedelta(days=1)
+    assert key("tomorrow") == key(tomorrow.isoformat())
+
+
+def test_weekday_words_in_free_text_are_not_dates():
+    for text in ["vegan so lecker", "was gibt es do", "mi amor :carrot:"]:
+        query = Query.from_text(text)
+        assert query.date is None and query.until is None, text
+
+
+@pytest.mark.parametrize(
+    "text, weekday", [("mi", "mi"), ("Mi :carrot: 3€", "mi"), (":seedling: so", "so")]
+)
+def test_single_weekday_on_its_own_is_a_date(text, weekday):
+    start, until = weekday_range(date.today(), WEEKDAYS[weekday], WEEKDAYS[weekday])
+    query = Query.from_text(text)
+    assert (query.date, query.until) == (start, until)
+
+
+def test_weekday_ranges_are_dates_in_free_text():
+    start, until = weekday_range(date.today(), *WEEK)
+    query = Query.from_text("linsen mo-fr")
+    assert (query.date, query.until) == (start, until)
+    assert key("woche") == key("mo - fr")
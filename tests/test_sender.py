@@ -0,0 +1,58 @@
+import random
+import threading
+import time
+from collections import defaultdict
+
+from telegram.error import RetryAfter
+
+from menstruation import sender
+
+
+class FastQueue(sender.MessageQueue):
+    GLOBAL_RATE = 10_000
+    CHAT_RATE = 10_000
+    CHAT_BURST = 10_000
+    WORKERS = 8
+
+
+def test_messages_to_one_chat_are_delivered_in_order():
+    outbox = FastQueue()
+    delivered = defaultdict(list)
+    lock = threading.Lock()
+
+    def send(chat_id, index):
+        time.sleep(random.uniform(0, 0.003))
+        with lock:
+            delivered[chat_id].append(index)
+
+    futures = [
+        outbox.submit(chat_id, sender.BULK, send, chat_id, index)
+        for index in range(20)
+        for chat_id in range(5)
+    ]
+    try:
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        outbox.stop()
+    assert dict(delivered) == {chat_id: list(range(20)) for chat_id in range(5)}
+
+
+def test_retried_message_keeps_its_place():
+    outbox = FastQueue()
+    delivered = []
+    failed = []
+
+    def send(index):
+        if index == 0 and not failed:
+            failed.append(index)
+            raise RetryAfter(0.05)
+        delivered.append(index)
+
+    futures = [outbox.submit(1, sender.BULK, send, index) for index in range(5)]
+    try:
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        outbox.stop()
+    assert delivered == list(range(5))
@@ -0,0 +1,69 @@
+import fakeredis
+import pytest
+
+from menstruation import shards
+from menstruation.shards import PartitionLeases
+
+PARTITIONS = 4
+TTL = 30
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(shards, "monotonic", lambda: now[0])
+    return now
+
+
+def test_single_instance_claims_all_partitions(redis_client, clock):
+    leases = PartitionLeases(redis_client, PARTITIONS, TTL)
+    leases.heartbeat()
+    assert leases.owned_partitions() == set(range(PARTITIONS))
+    assert all(leases.owns(user_id) for user_id in range(10))
+
+
+def test_partitions_are_not_owned_past_the_local_deadline(redis_client, clock):
+    leases = PartitionLeases(redis_client, PARTITIONS, TTL)
+    leases.heartbeat()
+    clock[0] += TTL - 1
+    assert leases.owned_partitions() == set(range(PARTITIONS))
+    clock[0] += 1
+    assert leases.owned_partitions() == set()
+    assert not leases.owns(1)
+
+
+def test_late_heartbeat_renews_leases_still_held(redis_client, clock):
+    leases = PartitionLeases(redis_client, PARTITIONS, TTL)
+    leases.heartbeat()
+    clock[0] += TTL * 2
+    leases.heartbeat()
+    assert leases.owned_partitions() == set(range(PARTITIONS))
+
+
+def test_late_heartbeat_drops_partitions_claimed_elsewhere(redis_client, clock):
+    late = PartitionLeases(redis_client, PARTITIONS, TTL)
+    late.heartbeat()
+    clock[0] += TTL * 2
+    for partition in range(PARTITIONS):
+        redis_client.delete(late.lease_key(partition))
+    redis_client.zrem(PartitionLeases.INSTANCES_KEY, late.instance)
+    other = PartitionLeases(redis_client, PARTITIONS, TTL)
+    other.heartbeat()
+    assert other.owned_partitions() == set(range(PARTITIONS))
+    late.heartbeat()
+    assert late.owned_partitions() == set()
+
+
+def test_release_frees_partitions_for_other_instances(redis_client, clock):
+    first = PartitionLeases(redis_client, PARTITIONS, TTL)
+    first.start()
+    first.release()
+    assert first.owned_partitions() == set()
+    second = PartitionLeases(redis_client, PARTITIONS, TTL)
+    second.heartbeat()
+    assert second.owned_partitions() == set(range(PARTITIONS))
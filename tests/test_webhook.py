@@ -0,0 +1,78 @@
+import json
+import os
+import threading
+from http.client import HTTPConnection
+from queue import Queue
+
+os.environ.setdefault("MENSTRUATION_TOKEN", "test")
+
+import pytest
+from telegram import Bot
+
+from menstruation.webhook import SECRET_HEADER, WebhookServer
+
+SECRET = "s3cr3t"
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 2,
+        "date": 0,
+        "chat": {"id": 3, "type": "private"},
+        "text": "/menu",
+    },
+}
+
+
+@pytest.fixture
+def server():
+    server = WebhookServer(
+        "127.0.0.1",
+        0,
+        "/telegram",
+        SECRET,
+        Bot("123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11"),
+        Queue(),
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body, path="/telegram", secret=SECRET) -> int:
+    connection = HTTPConnection(*server.server_address, timeout=5)
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers[SECRET_HEADER] = secret
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+    connection.request("POST", path, body=body, headers=headers)
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+def test_update_is_queued(server):
+    assert post(server, UPDATE) == 200
+    update = server.update_queue.get(timeout=1)
+    assert update.update_id == 1
+    assert update.message.text == "/menu"
+
+
+@pytest.mark.parametrize("secret", ["wrong", None])
+def test_wrong_or_missing_secret_is_forbidden(server, secret):
+    assert post(server, UPDATE, secret=secret) == 403
+    assert server.update_queue.empty()
+
+
+def test_wrong_path_is_not_found(server):
+    assert post(server, UPDATE, path="/other") == 404
+    assert server.update_queue.empty()
+
+
+@pytest.mark.parametrize(
+    "body", [b"{not json", [1], {"update_id": 1, "message": 5}, b"\xff"]
+)
+def test_malformed_body_is_rejected(server, body):
+    assert post(server, body) == 400
+    assert server.update_queue.empty()